@@ -0,0 +1,87 @@
+"""
+Collects the parts of a Telegram album.
+
+Telegram delivers an album as separate messages that share a
+media_group_id, normally a few hundred milliseconds apart. AlbumBuffer
+holds the parts until no new one has arrived for `window` seconds (or the
+album reaches Telegram's 10 item limit) and then passes the whole group to
+`on_flush(group_id, items)` on the buffer's own thread, so the caller can
+relay it with one send_media_group call. If on_flush raises, the error is
+logged and handed to `on_error(group_id, items)`, so the sender can be told.
+"""
+
+import logging
+import threading
+import time
+
+MAX_ITEMS = 10
+
+logger = logging.getLogger(__name__)
+
+
+class AlbumBuffer:
+    def __init__(self, on_flush, window=0.8, max_items=MAX_ITEMS, on_error=None):
+        self.on_flush = on_flush
+        self.on_error = on_error
+        self.window = window
+        self.max_items = max_items
+        self.albums = 0
+        self.items = 0
+        self.failed = 0
+        self._groups = {}  # group_id -> [deadline, items]
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, group_id, item):
+        full = None
+        with self._cond:
+            group = self._groups.get(group_id)
+            if group is None:
+                group = self._groups[group_id] = [0.0, []]
+            group[0] = time.monotonic() + self.window
+            group[1].append(item)
+            self.items += 1
+            if len(group[1]) >= self.max_items:
+                full = self._groups.pop(group_id)[1]
+            elif self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="albums", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        if full:
+            self._flush(group_id, full)
+
+    def flush_all(self):
+        with self._cond:
+            groups, self._groups = self._groups, {}
+        for group_id, (_, items) in groups.items():
+            self._flush(group_id, items)
+
+    def stats(self):
+        with self._cond:
+            return {"open": len(self._groups), "albums": self.albums, "items": self.items, "failed": self.failed}
+
+    def _flush(self, group_id, items):
+        self.albums += 1
+        try:
+            self.on_flush(group_id, items)
+        except Exception:
+            self.failed += 1
+            logger.exception(f"Album {group_id} could not be relayed")
+            if self.on_error:
+                try:
+                    self.on_error(group_id, items)
+                except Exception:
+                    logger.exception(f"Album {group_id} error callback failed")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [gid for gid, (deadline, _) in self._groups.items() if deadline <= now]
+                ready = [(gid, self._groups.pop(gid)[1]) for gid in due]
+                if not ready:
+                    next_deadline = min((d for d, _ in self._groups.values()), default=None)
+                    self._cond.wait(None if next_deadline is None else next_deadline - now)
+                    continue
+            for group_id, items in ready:
+                self._flush(group_id, items)
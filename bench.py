@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+GhostTalk micro-benchmarks.
+
+Runs offline against a throwaway database:
+    python bench.py            # every benchmark
+    python bench.py db         # just the named ones
+"""
+
+import os
+import random
+import re
+import sys
+import sqlite3
+import tempfile
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("DATA_PATH", tempfile.mkdtemp(prefix="ghosttalk-bench-"))
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+import bot  # noqa: E402
+
+
+class FakeUser:
+    def __init__(self, uid):
+        self.id = uid
+        self.username = f"user{uid}"
+        self.first_name = f"User {uid}"
+
+
+def timeit(fn, n):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - start) / n
+
+
+def report(label, seconds):
+    print(f"  {label:<40} {seconds * 1e6:10.1f} us")
+
+
+# DB overhead per update
+def legacy_get_conn():
+    # get_conn() as it was before the connection pool
+    db_parent = os.path.dirname(bot.DB_PATH) or bot.BASE_DIR
+    os.makedirs(db_parent, exist_ok=True)
+    c = sqlite3.connect(bot.DB_PATH, timeout=30, check_same_thread=False)
+    c.execute("PRAGMA journal_mode=WAL")
+    return c
+
+
+def text_update_db_work(i):
+    # The DB calls one relayed text message makes in handler()
+    uid = 1000 + (i % 200)
+    bot.is_banned(uid)
+    bot.db_new_user(FakeUser(uid))
+    bot.db_user(uid)
+    bot.incr_stat(uid, "messages_sent")
+
+
+def seed_users(count=200):
+    bot.init_db()
+    for uid in range(1000, 1000 + count):
+        bot.db_new_user(FakeUser(uid))
+
+
+def bench_db(n=2000):
+    seed_users()
+    pooled, cache = bot.get_conn, bot.user_cache
+    # Measure connection handling alone, without the profile cache
+    bot.user_cache = bot.UserCache(maxsize=0)
+    try:
+        bot.get_conn = legacy_get_conn
+        try:
+            before = timeit(text_update_db_work, n)
+        finally:
+            bot.get_conn = pooled
+        after = timeit(text_update_db_work, n)
+    finally:
+        bot.user_cache = cache
+
+    print("DB overhead per text update:")
+    report("fresh connection per call (old)", before)
+    report("pooled per-thread connection", after)
+    print(f"  speedup {before / after:.1f}x, pool {bot.db_pool.stats()}")
+
+
+def bench_cache(n=5000):
+    seed_users()
+    cache = bot.user_cache
+    bot.user_cache = bot.UserCache(maxsize=0)
+    try:
+        uncached = timeit(text_update_db_work, n)
+    finally:
+        bot.user_cache = cache
+    start = cache.stats()
+    cached = timeit(text_update_db_work, n)
+    end = cache.stats()
+    hits, misses = end["hits"] - start["hits"], end["misses"] - start["misses"]
+
+    print("User profile cache on the text update path:")
+    report("no cache", uncached)
+    report("LRU/TTL cache", cached)
+    print(f"  {hits} hits / {misses} misses ({hits / max(hits + misses, 1):.1%} hit rate)")
+
+
+def bench_counters(n=5000):
+    seed_users()
+
+    def sync_update(i):
+        with bot.get_conn() as conn:
+            conn.execute("UPDATE users SET messages_sent=messages_sent+1 WHERE user_id=?", (1000 + i % 200,))
+            conn.commit()
+
+    def buffered(i):
+        bot.incr_stat(1000 + i % 200, "messages_sent")
+
+    before = timeit(sync_update, n)
+    after = timeit(buffered, n)
+    start = time.perf_counter()
+    rows = bot.stat_buffer.flush()
+    flush = time.perf_counter() - start
+
+    print("messages_sent increment per relayed message:")
+    report("UPDATE + commit per message (old)", before)
+    report("write-behind buffer", after)
+    print(f"  pending flush: {rows} rows in {flush * 1e3:.1f} ms")
+
+
+CHAT_WORDS = (
+    "hey", "hi", "hello", "how", "are", "you", "doing", "today", "where", "from", "lol", "haha",
+    "what", "do", "like", "music", "movies", "india", "brazil", "student", "work", "night", "bored",
+    "same", "cool", "nice", "really", "why", "tell", "me", "about", "yourself", "class", "assignment",
+    "mcdonalds", "scunthorpe", "pushing", "cocktail", "dickens", "analysis", "grape", "therapist",
+)
+
+
+def chat_corpus(n, seed=7):
+    rng = random.Random(seed)
+    words = bot.BANNED_WORDS
+    corpus = []
+    for _ in range(n):
+        msg = [rng.choice(CHAT_WORDS) for _ in range(rng.randint(1, 14))]
+        roll = rng.random()
+        if roll < 0.03:
+            msg.insert(rng.randrange(len(msg) + 1), rng.choice(words).upper())
+        elif roll < 0.04:
+            msg.append("check www.example.com")
+        corpus.append(" ".join(msg))
+    return corpus
+
+
+def bench_moderation(n=20000):
+    legacy = [re.compile(rf"\b{re.escape(w)}\b", re.IGNORECASE) for w in bot.BANNED_WORDS]
+
+    def legacy_check(text):
+        # has_bad_content() as it was: link regex, then one regex per word
+        if bot.LINK_PATTERN.search(text):
+            return True
+        for p in legacy:
+            if p.search(text):
+                return True
+        return False
+
+    corpus = chat_corpus(n)
+    mismatches = [t for t in corpus if legacy_check(t) != bot.has_bad_content(t)]
+    flagged = sum(map(bot.has_bad_content, corpus))
+    before = timeit(lambda i: legacy_check(corpus[i]), n)
+    after = timeit(lambda i: bot.has_bad_content(corpus[i]), n)
+
+    print(f"Moderation over {n} chat messages ({flagged} flagged, {len(mismatches)} mismatches):")
+    report("regex per banned word (old)", before)
+    report("single trie alternation", after)
+    print(f"  speedup {before / after:.1f}x")
+
+
+BENCH_COUNTRIES = ("India", "Brazil", "Indonesia", "Philippines", "Nigeria", "Mexico", "Egypt", "Turkey",
+                   "Pakistan", "Bangladesh") + tuple(f"Country {i}" for i in range(90))
+
+
+def synthetic_searchers(n, first=1, seed=11):
+    """(uid, gender, country, age, prefs) with a chat app's mix: mostly men, a third of searches filtered."""
+    from matchmaking import OPPOSITE, Prefs
+
+    rng = random.Random(seed)
+    weights = [40, 20, 10, 8, 6, 5, 4, 3, 2, 2] + [0.1] * 90
+    out = []
+    for uid in range(first, first + n):
+        gender = rng.choices(("Male", "Female", None), (75, 20, 5))[0]
+        country = rng.choices(BENCH_COUNTRIES, weights)[0]
+        age = rng.randint(16, 40)
+        roll = rng.random()
+        if roll < 0.5:
+            prefs = Prefs()
+        elif roll < 0.7:
+            prefs = Prefs(OPPOSITE.get(gender))
+        elif roll < 0.85:
+            prefs = Prefs(OPPOSITE.get(gender), country=country)
+        else:
+            lo = rng.randint(16, 35)
+            prefs = Prefs(OPPOSITE.get(gender), rng.choice((None, country)), (lo, lo + rng.randint(2, 8)))
+        out.append((uid, gender, country, age, prefs))
+    return out
+
+
+class LinearQueue:
+    """The same pairing rule as MatchQueue, by scanning every waiter oldest first."""
+
+    def __init__(self):
+        self.waiting = {}
+
+    def enqueue(self, uid, gender, country=None, age=None, prefs=None, since=None):
+        self.waiting[uid] = SimpleNamespace(gender=gender, country=country, age=age, prefs=prefs)
+
+    def arrive(self, uid):
+        w = self.waiting[uid]
+        for other_uid, other in self.waiting.items():
+            if other_uid != uid and w.prefs.accepts(other) and other.prefs.accepts(w):
+                del self.waiting[uid], self.waiting[other_uid]
+                return other_uid
+        return None
+
+
+def bench_match(n=60000, arrivals=2000):
+    from matchmaking import MatchQueue
+
+    queue = MatchQueue(hidden={0})
+    linear = LinearQueue()
+    start = time.perf_counter()
+    for uid, gender, country, age, prefs in synthetic_searchers(n):
+        queue.enqueue(uid, gender, country=country, age=age, prefs=prefs)
+    enqueued = time.perf_counter() - start
+    start = time.perf_counter()
+    pairs = queue.match()
+    matched = time.perf_counter() - start
+    left = len(queue)
+    for uid, gender, _, extra in queue.export():
+        linear.enqueue(uid, gender, **extra)
+
+    incoming = synthetic_searchers(arrivals, first=n + 1, seed=12)
+    start = time.perf_counter()
+    indexed_pairs = 0
+    for uid, gender, country, age, prefs in incoming:
+        queue.enqueue(uid, gender, country=country, age=age, prefs=prefs)
+        indexed_pairs += len(queue.match())
+    indexed = (time.perf_counter() - start) / arrivals
+    start = time.perf_counter()
+    linear_pairs = 0
+    for uid, gender, country, age, prefs in incoming:
+        linear.enqueue(uid, gender, country=country, age=age, prefs=prefs)
+        linear_pairs += linear.arrive(uid) is not None
+    scanned = (time.perf_counter() - start) / arrivals
+
+    print(f"Matchmaking with {n} synthetic searchers (half with gender/country/age filters):")
+    report("enqueue (per user)", enqueued / n)
+    report(f"match pass ({len(pairs)} pairs, per pair)", matched / max(len(pairs), 1))
+    print(f"  {left} left waiting, then {arrivals} arrivals (enqueue + match, per arrival):")
+    report(f"linear scan (old) ({linear_pairs} matched)", scanned)
+    report(f"multi-key index ({indexed_pairs} matched)", indexed)
+
+
+# Batch matching: one pass per scheduler tick instead of one per search
+def bench_scheduler(rate=100, seconds=300, ticks=(0, 0.1, 0.5, 2)):
+    import threading
+    from matchmaking import MatchQueue, MatchScheduler, percentile
+    from sessions import MemoryBackend
+
+    arrivals = synthetic_searchers(rate * seconds, seed=13)
+    print(f"Match scheduler, {rate} searches/s for {seconds}s (simulated clock):")
+    print(f"  {'tick':<8} {'passes':>7} {'pairs/pass':>10} {'us/search':>10} {'left':>6}"
+          f"  wait p50/p95 all, opposite-only")
+    for tick in ticks:
+        now = [0.0]
+        queue = MatchQueue(widen_after=30, clock=lambda: now[0])
+        waits = {}
+        kinds = {}
+
+        def run_pass():
+            pairs = queue.match()
+            return pairs, queue.last_waits
+
+        def on_pass(pairs, pass_waits):
+            for uid, wait in zip((uid for pair in pairs for uid in pair), pass_waits):
+                waits[uid] = wait
+
+        scheduler = MatchScheduler(run_pass, tick=tick, on_pass=on_pass)
+        spent = 0.0
+        next_tick = 0.0
+        for i, (uid, gender, country, age, prefs) in enumerate(arrivals):
+            now[0] = i / rate
+            while tick and now[0] >= next_tick:
+                start = time.perf_counter()
+                scheduler.run_once()
+                spent += time.perf_counter() - start
+                next_tick += tick
+            queue.enqueue(uid, gender, country=country, age=age, prefs=prefs, since=now[0])
+            kinds[uid] = prefs.gender is not None and not prefs.country and not prefs.ages
+            if not tick:
+                start = time.perf_counter()
+                scheduler.run_once()
+                spent += time.perf_counter() - start
+        opposite = [wait for uid, wait in waits.items() if kinds[uid]]
+        everyone = list(waits.values())
+        label = f"{tick}s" if tick else "search"
+        print(f"  {label:<8} {scheduler.passes:>7} {scheduler.matched / max(scheduler.passes, 1):>10.2f}"
+              f" {spent / len(arrivals) * 1e6:>10.1f} {len(queue):>6}"
+              f"  {percentile(everyone, 0.5):5.1f}s {percentile(everyone, 0.95):5.1f}s,"
+              f" {percentile(opposite, 0.5):5.1f}s {percentile(opposite, 0.95):5.1f}s")
+
+    # The real thread: several handler threads enqueueing and notifying at once
+    backend = MemoryBackend()
+    claimed = []
+    scheduler = MatchScheduler(lambda: (backend.claim_matches(), backend.last_waits), tick=0.05,
+                               on_pass=lambda pairs, waits: claimed.extend(pairs))
+
+    def handler_thread(first):
+        for uid, gender, country, age, prefs in synthetic_searchers(2000, first=first, seed=first):
+            backend.queue.enqueue(uid, gender, country=country, age=age, prefs=prefs)
+            scheduler.notify()
+
+    threads = [threading.Thread(target=handler_thread, args=(1 + t * 2000,)) for t in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    scheduler.notify()
+    time.sleep(0.2)
+    seen = [uid for pair in claimed for uid in pair]
+    print(f"  threaded: {scheduler.passes} passes, {len(claimed)} pairs, left waiting {len(backend.queue)}, "
+          f"double-matched {len(seen) - len(set(seen))}, errors {scheduler.errors}")
+
+
+# Shared session backend: several processes matching one queue
+def _session_worker(path, first, count, out):
+    from sessions import SqliteBackend
+    backend = SqliteBackend(path)
+    genders = ("Male", "Female")
+    pairs = []
+    for uid in range(first, first + count):
+        backend.queue.enqueue(uid, genders[uid % 2], opposite=uid % 7 == 0)
+        if uid % 10 == 0:
+            pairs += backend.claim_matches()
+    pairs += backend.claim_matches()
+    out.put(pairs)
+
+
+def bench_sessions(workers=4, per_worker=2000):
+    import multiprocessing
+
+    path = os.path.join(tempfile.mkdtemp(prefix="ghosttalk-sessions-"), "sessions.db")
+    from sessions import SqliteBackend
+    SqliteBackend(path)
+    out = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_session_worker, args=(path, 1 + w * per_worker, per_worker, out))
+             for w in range(workers)]
+    start = time.perf_counter()
+    for p in procs:
+        p.start()
+    pairs = [pair for _ in procs for pair in out.get()]
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    seen = [uid for pair in pairs for uid in pair]
+    backend = SqliteBackend(path)
+    print(f"Shared sessions, {workers} processes x {per_worker} searchers:")
+    report("enqueue + match (per searcher)", elapsed / (workers * per_worker))
+    print(f"  pairs {len(pairs)}, left waiting {len(backend.queue)}, "
+          f"double-matched {len(seen) - len(set(seen))}, pairs rows {len(backend.pairs)}")
+
+
+# Conversation logs: bytes stored and write time per disconnect
+def conversation_logs(n, per=50, seed=3):
+    rng = random.Random(seed)
+    logs = []
+    for i in range(n):
+        cid, mid = 5_000_000_000 + i, rng.randint(1, 2_000_000)
+        msgs = []
+        for _ in range(rng.randint(per // 2, per)):
+            mid += rng.randint(1, 4)
+            msgs.append((cid, mid))
+        logs.append(msgs)
+    return logs
+
+
+def bench_convlog(n=2000):
+    bot.init_db()
+    logs = conversation_logs(n)
+    now = bot.datetime.utcnow().isoformat()
+
+    def write(encode):
+        conn = bot.get_conn()
+        start = time.perf_counter()
+        for msgs in logs:
+            conn.execute("""
+                INSERT INTO chat_conversations (user1_id, user2_id, start_time, end_time, messages_log)
+                VALUES (?, ?, ?, ?, ?)
+            """, (1, 2, now, now, encode(msgs)))
+            conn.commit()
+        return (time.perf_counter() - start) / n
+
+    legacy = sum(len(str(msgs)) for msgs in logs) / n
+    compact = sum(len(bot.encode_log(msgs)) for msgs in logs) / n
+    before = write(str)
+    after = write(bot.encode_log)
+    assert all(bot.decode_log(bot.encode_log(msgs)) == msgs for msgs in logs)
+    assert all(bot.decode_log(str(msgs)) == msgs for msgs in logs[:100])
+
+    print(f"Conversation log per disconnect ({n} chats, ~{sum(map(len, logs)) // n} messages):")
+    print(f"  repr text (old) {legacy:10.0f} bytes   compact {compact:6.0f} bytes   ({legacy / compact:.1f}x smaller)")
+    report("encode + INSERT + commit, repr (old)", before)
+    report("encode + INSERT + commit, compact", after)
+
+
+def bench_markup(n=20000):
+    seed_users()
+    bot.db_set_gender(1001, "Male")
+
+    def legacy(i):
+        # main_kb() as it was: a fresh markup and two profile reads per reply, serialised on send
+        kb = bot._build_main_kb("premium" if bot.is_premium(1001) else "free" if bot.db_user(1001)["gender"] else "new")
+        bot.apihelper._convert_markup(kb)
+
+    def prebuilt(i):
+        bot.apihelper._convert_markup(bot.main_kb(1001))
+
+    before = timeit(legacy, n)
+    after = timeit(prebuilt, n)
+    print("Main keyboard per reply:")
+    report("build + serialise (old)", before)
+    report("prebuilt variant", after)
+
+
+# Query plans: no statement the bot runs may scan a whole table
+FULL_SCAN_OK = (
+    "SELECT user_id, ban_until, permanent FROM bans",  # BanIndex loads every ban on purpose
+    # Walks the rowid backwards and stops at the first row
+    "SELECT id, status, cursor, sent, failed, blocked, created_at, finished_at FROM broadcasts ORDER BY id DESC LIMIT 1",
+)
+
+
+def fake_message(uid, text):
+    return bot.types.Message.de_json({
+        "message_id": 1, "date": 0, "text": text,
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": f"User {uid}", "username": f"user{uid}"},
+    })
+
+
+def exercise_queries():
+    # Drive the DB helpers and the handlers with inline SQL so TimedConnection sees every statement
+    seed_users()
+    for i in range(50):
+        text_update_db_work(i)
+    bot.stat_buffer.flush()
+    bot.db_set_gender(1001, "Male")
+    bot.db_set_age(1001, 20)
+    bot.db_set_country(1001, "India", "🇮🇳")
+    bot.add_referral(1002)
+    bot.set_premium(1003, (bot.datetime.utcnow() + bot.timedelta(hours=1)).isoformat())
+    bot.remove_premium(1003)
+    bot.premium_expired(1003, "2000-01-01T00:00:00")
+    bot.add_report(1001, 1002)
+    bot.count_reports(1002)
+    bot.ban_user(1004, hours=1)
+    bot.unban_user(1004)
+    bot.resolve_id("@User1005")
+    bot.chat_history.save(1001, 1001, 7)
+    bot.sessions.pair(1001, 1002)
+    bot.disc_user(1001)
+    code = bot.db_user(1002)["referral_code"]
+    bot.cmd_start(fake_message(1006, f"/start {code}"))
+    bot.cmd_chatlog(fake_message(bot.ADMIN_ID, "/chatlog 1002"))
+    bot.cmd_broadcast(fake_message(bot.ADMIN_ID, "/broadcast status"))
+    bot.broadcaster.resume()
+    bot.meta_set("bench", "1")
+    bot.meta_get("bench")
+
+
+def bench_plans():
+    sends = bot.bot.send_message, bot.bot.reply_to
+    bot.bot.send_message = bot.bot.reply_to = lambda *a, **k: None
+    try:
+        exercise_queries()
+    finally:
+        bot.bot.send_message, bot.bot.reply_to = sends
+
+    conn = bot.get_conn()
+    checked, scans = 0, []
+    for sql in list(bot._SQL_OPS):
+        if sql.split(None, 1)[0].upper() not in ("SELECT", "UPDATE", "DELETE", "INSERT"):
+            continue
+        checked += 1
+        plan = conn.execute("EXPLAIN QUERY PLAN " + sql, (None,) * sql.count("?")).fetchall()
+        for row in plan:
+            detail = row[-1]
+            if detail.startswith("SCAN") and "CONSTANT ROW" not in detail and " ".join(sql.split()) not in FULL_SCAN_OK:
+                scans.append((" ".join(sql.split()), detail))
+
+    print(f"Query plans: {checked} distinct statements checked")
+    for sql, detail in scans:
+        print(f"  FULL SCAN {detail}: {sql}")
+    if scans:
+        sys.exit(1)
+    print("  no full table scans")
+
+
+BENCHES = {
+    "db": bench_db,
+    "cache": bench_cache,
+    "counters": bench_counters,
+    "match": bench_match,
+    "scheduler": bench_scheduler,
+    "moderation": bench_moderation,
+    "sessions": bench_sessions,
+    "convlog": bench_convlog,
+    "markup": bench_markup,
+    "plans": bench_plans,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        if name not in BENCHES:
+            sys.exit(f"unknown benchmark '{name}', pick from: {', '.join(BENCHES)}")
+        BENCHES[name]()
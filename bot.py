@@ -7,24 +7,46 @@ UPDATED: Report Forwarding + Reconnect Logic + Admin Invisibility
 
 import os
 import re
+import asyncio
+import hmac
+import atexit
+import hashlib
+import json
+import signal
+import functools
 import sqlite3
 import random
 import secrets
 import threading
 import logging
+import math
 import time
-from datetime import datetime, timedelta
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import requests
 import telebot
-from telebot import types
-from flask import Flask
+from telebot import apihelper, types
+from flask import Flask, Response, request
+
+from albums import AlbumBuffer
+from convlog import decode as decode_log, encode as encode_log, parse_legacy as parse_legacy_log
+from history import ChatHistory
+from matchmaking import OPPOSITE, MatchScheduler, Prefs
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry
+from outbox import Outbox, PRIORITY_RELAY, PRIORITY_NOTIFY, PRIORITY_BULK
+from profiling import MODES as PROFILE_MODES, Profiler
+from sessions import open_sessions
+from ttlmap import TTLMap
 
 # Config
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_PATH = os.getenv("DATA_PATH") or os.path.join(BASE_DIR, "data")
 os.makedirs(DATA_PATH, exist_ok=True)
 DB_PATH = os.getenv("DB_PATH") or os.path.join(DATA_PATH, "ghosttalk.db")
+BANNED_WORDS_FILE = os.getenv("BANNED_WORDS_FILE") or os.path.join(DATA_PATH, "banned_words.txt")
 
 API_TOKEN = os.getenv("BOT_TOKEN") or os.getenv("TELEGRAM_BOT_TOKEN") or "YOUR_BOT_TOKEN_HERE"
 ADMIN_ID = int(os.getenv("ADMIN_ID", 8361006824))
@@ -34,14 +56,143 @@ TEMP_BAN_HOURS = 24
 PREMIUM_REFERRALS_NEEDED = 3
 PREMIUM_DURATION_HOURS = 1
 RECONNECT_WINDOW_MINUTES = 5
+# /filter searches loosen a step (wider ages, then any country, then any age) each time this passes
+MATCH_WIDEN_SECONDS = int(os.getenv("MATCH_WIDEN_SECONDS", 30))
+# Matching runs on its own thread: right after a search starts, and at least this often
+MATCH_TICK_MS = int(os.getenv("MATCH_TICK_MS", 500))
+PENDING_MEDIA_MINUTES = 60
+PENDING_PROMPT_MINUTES = 30
+ALBUM_WINDOW_MS = int(os.getenv("ALBUM_WINDOW_MS", 800))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 20))  # msgs/s, under SEND_RATE_GLOBAL so chats keep flowing
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", 200))
+# A reporter counts once per reported user per window; 0 counts every report
+REPORT_DEDUP_HOURS = float(os.getenv("REPORT_DEDUP_HOURS", 24))
+# Half-life of report counts; 0 keeps lifetime totals
+REPORT_DECAY_HOURS = float(os.getenv("REPORT_DECAY_HOURS", 0))
+# Raw report rows older than this are pruned at startup; 0 keeps them forever
+REPORT_RETENTION_DAYS = int(os.getenv("REPORT_RETENTION_DAYS", 0))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 300))
+STAT_FLUSH_MS = int(os.getenv("STAT_FLUSH_MS", 2000))
+STAT_FLUSH_MAX = int(os.getenv("STAT_FLUSH_MAX", 500))
+BOT_INFO_REFRESH_HOURS = float(os.getenv("BOT_INFO_REFRESH_HOURS", 24))
+
+# "polling" keeps the long-poll thread, "webhook" takes updates on WEBHOOK_PATH
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"ghosttalk:{API_TOKEN}".encode()).hexdigest()[:48]
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE = int(os.getenv("WEBHOOK_QUEUE", 256))
+# Polling runtime: "threaded" (TeleBot worker pool) or "asyncio" (AsyncTeleBot, needs aiohttp)
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "threaded").strip().lower()
+ASYNC_DB_WORKERS = int(os.getenv("ASYNC_DB_WORKERS", 4))
+ASYNC_SYNC_WORKERS = int(os.getenv("ASYNC_SYNC_WORKERS", 8))
+ASYNC_MAX_UPDATES = int(os.getenv("ASYNC_MAX_UPDATES", 256))  # queued (and as many running) before polling waits
+
+# The global rate is the bot's total and is split between gunicorn workers; the per-chat
+# limits apply in each process, since a chat's updates can reach any worker
+SEND_RATE_GLOBAL = float(os.getenv("SEND_RATE_GLOBAL", 30))
+SEND_RATE_CHAT = float(os.getenv("SEND_RATE_CHAT", 1))
+SEND_BURST_CHAT = int(os.getenv("SEND_BURST_CHAT", 3))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", 4))
+
+HISTORY_PER_USER = 50
+HISTORY_MAX_MB = int(os.getenv("HISTORY_MAX_MB", 64))
+HISTORY_IDLE_HOURS = int(os.getenv("HISTORY_IDLE_HOURS", 6))
+
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH") or os.path.join(DATA_PATH, "sessions.snap")
+SNAPSHOT_SECONDS = int(os.getenv("SNAPSHOT_SECONDS", 30))
+SNAPSHOT_MAX_AGE_MINUTES = int(os.getenv("SNAPSHOT_MAX_AGE_MINUTES", 15))
+
+# "memory" keeps sessions in this process; "sqlite" shares them between gunicorn workers
+# on one box (webhook mode only - every worker would otherwise long-poll the same bot)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory").strip().lower()
+# gunicorn's worker count: Procfile and render.yaml pass -w ${WEB_CONCURRENCY:-1}
+WEB_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH") or os.path.join(DATA_PATH, "sessions.db")
+CACHE_SYNC_SECONDS = float(os.getenv("CACHE_SYNC_SECONDS", 1))
+
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(DATA_PATH, "profiles")
+PROFILE_SAMPLE_MS = float(os.getenv("PROFILE_SAMPLE_MS", 5))
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 logger.info(f"Starting bot... DB: {DB_PATH}")
-
-bot = telebot.TeleBot(API_TOKEN)
+if WEB_WORKERS > 1 and SESSION_BACKEND == "memory":
+    # Each worker would have its own queue and chats, and partners would land in different processes
+    logger.error(f"WEB_CONCURRENCY={WEB_WORKERS} needs SESSION_BACKEND=sqlite; set one or the other")
+    raise RuntimeError("several workers with SESSION_BACKEND=memory")
+
+# Metrics
+metrics = Registry()
+HANDLER_LATENCY = metrics.histogram("ghosttalk_handler_seconds", "Bot handler run time", ("handler",))
+HANDLER_CALLS = metrics.counter("ghosttalk_handler_calls_total", "Bot handler calls", ("handler", "status"))
+MATCH_LATENCY = metrics.histogram("ghosttalk_match_seconds", "match_users() run time")
+MATCH_WAIT = metrics.histogram("ghosttalk_match_wait_seconds", "Time from search to partner",
+                               buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800))
+MATCH_PAIRS = metrics.counter("ghosttalk_matches_total", "Chats started by the matcher")
+DB_LATENCY = metrics.histogram("ghosttalk_db_seconds", "SQLite statement time", ("op",))
+API_LATENCY = metrics.histogram("ghosttalk_api_seconds", "Telegram Bot API call time", ("method",))
+API_CALLS = metrics.counter("ghosttalk_api_calls_total", "Telegram Bot API calls", ("method", "status"))
+
+_orig_make_request = apihelper._make_request
+
+def _timed_request(token, method_name, *args, **kwargs):
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        return _orig_make_request(token, method_name, *args, **kwargs)
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        API_LATENCY.observe(time.perf_counter() - start, method_name)
+        API_CALLS.inc(method_name, status)
+
+apihelper._make_request = _timed_request
+
+# Off until an admin runs /profile; handlers then go through profiler.run()
+profiler = Profiler(PROFILE_DIR, interval=PROFILE_SAMPLE_MS / 1000)
+
+def timed_handler(fn):
+    name = fn.__name__
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            if profiler.active:
+                return profiler.run(name, fn, *args, **kwargs)
+            return fn(*args, **kwargs)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+            HANDLER_CALLS.inc(name, status)
+    return wrapper
+
+# In webhook mode updates already run on UpdateWorkers, and the asyncio runtime calls
+# process_new_updates() from its own executor, so handlers are called inline
+bot = telebot.TeleBot(API_TOKEN, threaded=BOT_MODE != "webhook" and BOT_RUNTIME != "asyncio")
 app = Flask(__name__)
 
+# Outbound - every send is paced by the outbox; pass priority=PRIORITY_RELAY for chat content
+outbox = Outbox(global_rate=SEND_RATE_GLOBAL / WEB_WORKERS, chat_rate=SEND_RATE_CHAT, chat_burst=SEND_BURST_CHAT,
+                workers=SEND_WORKERS)
+
+def _via_outbox(fn):
+    def send(chat_id, *args, priority=PRIORITY_NOTIFY, **kwargs):
+        return outbox.call(fn, chat_id, *args, priority=priority, **kwargs)
+    return send
+
+_unqueued = {}  # the original senders, for callers that submit to the outbox themselves
+for _name in ("send_photo", "send_document", "send_video", "send_animation", "send_sticker",
+              "send_audio", "send_voice", "send_media_group", "forward_message"):
+    _unqueued[_name] = getattr(bot, _name)
+    setattr(bot, _name, _via_outbox(_unqueued[_name]))
+
 # Fix \n display
 try:
     _orig_send = bot.send_message
@@ -54,19 +205,30 @@ def fix_newlines(text):
     return text.replace("\\n", "\n") if isinstance(text, str) else text
 
 if _orig_send:
-    bot.send_message = lambda chat_id, text, *args, **kwargs: _orig_send(chat_id, fix_newlines(text), *args, **kwargs)
+    _unqueued["send_message"] = lambda chat_id, text, *args, **kwargs: _orig_send(chat_id, fix_newlines(text), *args, **kwargs)
+    _queued_send = _via_outbox(_orig_send)
+    bot.send_message = lambda chat_id, text, *args, **kwargs: _queued_send(chat_id, fix_newlines(text), *args, **kwargs)
 if _orig_callback:
     bot.answer_callback_query = lambda cid, text=None, *args, **kwargs: _orig_callback(cid, fix_newlines(text) if text else text, *args, **kwargs)
 
-# Runtime
-waiting_random = []
-waiting_opposite = []
-active_pairs = {}
-pending_media = {}
-chat_history = {}
-report_reason_pending = {}
-pending_country = set()
-last_partner_disconnect = {}
+# Runtime - session state lives in the backend; chat_history and the outbox stay per process
+sessions = open_sessions(SESSION_BACKEND, SESSION_DB_PATH,
+                         hidden={ADMIN_ID},  # admin is invisible to random matching
+                         widen_after=MATCH_WIDEN_SECONDS or None,
+                         pending_media_ttl=PENDING_MEDIA_MINUTES * 60,
+                         prompt_ttl=PENDING_PROMPT_MINUTES * 60,
+                         reconnect_ttl=RECONNECT_WINDOW_MINUTES * 60,
+                         handler_modules={__name__})
+if sessions.handlers is not None:
+    bot.next_step_backend = sessions.handlers
+match_queue = sessions.queue
+active_pairs = sessions.pairs
+pending_media = sessions.pending_media
+chat_history = ChatHistory(HISTORY_PER_USER, HISTORY_MAX_MB * 1024 * 1024, HISTORY_IDLE_HOURS * 3600,
+                           is_active=lambda uid: uid in active_pairs)
+report_reason_pending = sessions.report_reason_pending
+pending_country = sessions.pending_country
+last_partner_disconnect = sessions.reconnect
 
 # Words
 BANNED_WORDS = [
@@ -76,7 +238,63 @@ BANNED_WORDS = [
     "chot", "chuut", "gand", "gaand", "ma ka lauda", "mkc", "teri ma ki chut", "teri ma ki chuut"
 ]
 LINK_PATTERN = re.compile(r'https?://|www\.', re.IGNORECASE)
-BANNED_PATTERNS = [re.compile(rf'\b{re.escape(w)}\b', re.IGNORECASE) for w in BANNED_WORDS]
+
+def trie_regex(words):
+    """One alternation for all words, nested by shared prefix (anj(?:ing)?|asu|ass(?:hole)?...)."""
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        alt = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            return f"(?:{alt})?"
+        return alt
+
+    return build(trie)
+
+class ModerationFilter:
+    """Links and banned words checked by a single compiled regex.
+
+    load() builds the new matcher first and swaps it in with one assignment,
+    so messages being checked on other threads never see a half-built list.
+    """
+
+    def __init__(self, words):
+        self.load(words)
+
+    def load(self, words):
+        words = sorted({w.strip().lower() for w in words if w.strip()})
+        pattern = LINK_PATTERN.pattern
+        if words:
+            pattern += rf"|\b{trie_regex(words)}\b"
+        self._state = (re.compile(pattern, re.IGNORECASE), tuple(words))
+        return len(words)
+
+    def load_file(self, path):
+        with open(path, encoding="utf-8") as f:
+            words = [line.split("#", 1)[0] for line in f]
+        return self.load(words)
+
+    @property
+    def words(self):
+        return self._state[1]
+
+    def search(self, text):
+        return self._state[0].search(text) is not None
+
+moderation = ModerationFilter(BANNED_WORDS)
+if os.path.exists(BANNED_WORDS_FILE):
+    try:
+        moderation.load_file(BANNED_WORDS_FILE)
+    except Exception as e:
+        logger.error(f"Couldn't load {BANNED_WORDS_FILE}, using built-in words: {e}")
 
 # Countries
 COUNTRIES = {
@@ -139,62 +357,540 @@ def get_country_info(inp):
     return None
 
 # Database
+_SQL_OPS = {}
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that records every statement in DB_LATENCY, labelled by verb."""
+
+    def _observe(self, sql, start):
+        op = _SQL_OPS.get(sql)
+        if op is None:
+            op = _SQL_OPS[sql] = (sql.split(None, 1) or ["?"])[0].upper()
+        DB_LATENCY.observe(time.perf_counter() - start, op)
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._observe(sql, start)
+
+    def executemany(self, sql, params):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, params)
+        finally:
+            self._observe(sql, start)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self._observe("COMMIT", start)
+
+class ConnectionPool:
+    """One SQLite connection per thread, opened once with every PRAGMA applied.
+
+    Connections keep a statement cache so the helpers below reuse their
+    prepared statements, get a cheap SELECT 1 health check every
+    `health_interval` seconds, and are all closed by close_all() on shutdown.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=30000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",
+    )
+
+    def __init__(self, path, statement_cache=256, health_interval=60, factory=sqlite3.Connection):
+        self.path = path
+        self.factory = factory
+        self.statement_cache = statement_cache
+        self.health_interval = health_interval
+        self.opened = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns = {}
+        self._generation = 0
+
+    def _open(self):
+        db_parent = os.path.dirname(self.path) or BASE_DIR
+        os.makedirs(db_parent, exist_ok=True)
+        c = sqlite3.connect(self.path, timeout=30, check_same_thread=False,
+                            cached_statements=self.statement_cache, factory=self.factory)
+        for pragma in self.PRAGMAS:
+            c.execute(pragma)
+        me = threading.current_thread()
+        with self._lock:
+            # Drop connections owned by threads that have exited
+            for ident, (owner, old) in list(self._conns.items()):
+                if not owner.is_alive():
+                    del self._conns[ident]
+                    try:
+                        old.close()
+                    except sqlite3.Error:
+                        pass
+            self._conns[me.ident] = (me, c)
+            self.opened += 1
+            self._local.generation = self._generation
+        self._local.conn = c
+        self._local.checked = time.monotonic()
+        return c
+
+    def _healthy(self, c):
+        try:
+            c.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def get(self):
+        c = getattr(self._local, "conn", None)
+        if c is None or self._local.generation != self._generation:
+            return self._open()
+        now = time.monotonic()
+        if now - self._local.checked > self.health_interval:
+            self._local.checked = now
+            if not self._healthy(c):
+                logger.warning("DB connection failed health check, reopening")
+                return self._open()
+        return c
+
+    def stats(self):
+        with self._lock:
+            return {"open": len(self._conns), "opened_total": self.opened}
+
+    def close_all(self):
+        with self._lock:
+            conns = [c for _, c in self._conns.values()]
+            self._conns.clear()
+            self._generation += 1
+        for c in conns:
+            try:
+                c.close()
+            except sqlite3.Error:
+                pass
+
+db_pool = ConnectionPool(DB_PATH, factory=TimedConnection)
+
 def get_conn():
-    db_parent = os.path.dirname(DB_PATH) or BASE_DIR
-    os.makedirs(db_parent, exist_ok=True)
-    c = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
-    c.execute("PRAGMA journal_mode=WAL")
-    return c
+    return db_pool.get()
+
+# Migrations - each runs once, in order; PRAGMA user_version counts how many have run.
+# Append new schema changes to the end, never edit or reorder released ones.
+MIGRATIONS = []
+
+def migration(fn):
+    MIGRATIONS.append(fn)
+    return fn
+
+@migration
+def _m001_tables(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        gender TEXT,
+        age INTEGER,
+        country TEXT,
+        country_flag TEXT,
+        messages_sent INTEGER DEFAULT 0,
+        media_approved INTEGER DEFAULT 0,
+        media_rejected INTEGER DEFAULT 0,
+        referral_code TEXT UNIQUE,
+        referral_count INTEGER DEFAULT 0,
+        premium_until TEXT,
+        joined_at TEXT
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS bans (
+        user_id INTEGER PRIMARY KEY,
+        ban_until TEXT,
+        permanent INTEGER DEFAULT 0,
+        reason TEXT
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reporter_id INTEGER,
+        reported_id INTEGER,
+        timestamp TEXT
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS chat_conversations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user1_id INTEGER,
+        user2_id INTEGER,
+        start_time TEXT,
+        end_time TEXT,
+        messages_log TEXT
+    )
+    """)
+
+@migration
+def _m002_hot_path_indexes(conn):
+    # /chatlog's per-reporter breakdown of a user's reports
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_reported ON reports (reported_id, reporter_id)")
+    # resolve_id() matches usernames case-insensitively
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (LOWER(username))")
+    # /chatlog: latest conversations on either side (referral_code already has its UNIQUE index)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conv_user1 ON chat_conversations (user1_id, end_time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conv_user2 ON chat_conversations (user2_id, end_time)")
+
+@migration
+def _m003_report_counts(conn):
+    # Ban checks read a maintained score instead of counting raw reports
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS report_counts (
+        user_id INTEGER PRIMARY KEY,
+        score REAL NOT NULL DEFAULT 0,
+        updated REAL NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS report_dedup (
+        reporter_id INTEGER,
+        reported_id INTEGER,
+        last_at REAL NOT NULL,
+        PRIMARY KEY (reporter_id, reported_id)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    INSERT OR REPLACE INTO report_counts (user_id, score, updated)
+    SELECT reported_id, COUNT(*), ? FROM reports WHERE reported_id IS NOT NULL GROUP BY reported_id
+    """, (time.time(),))
+    conn.execute("""
+    INSERT OR REPLACE INTO report_dedup (reporter_id, reported_id, last_at)
+    SELECT reporter_id, reported_id, COALESCE(MAX(CAST(strftime('%s', timestamp) AS REAL)), 0)
+    FROM reports WHERE reporter_id IS NOT NULL AND reported_id IS NOT NULL
+    GROUP BY reporter_id, reported_id
+    """)
+
+@migration
+def _m004_compact_chat_logs(conn):
+    # Rewrite the repr() logs older versions stored in the compact binary format. Rows
+    # that don't parse are left as they are, for someone to look at
+    last = 0
+    skipped = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, messages_log FROM chat_conversations
+            WHERE id > ? AND typeof(messages_log) = 'text' ORDER BY id LIMIT 500
+        """, (last,)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for cid, log in rows:
+            try:
+                updates.append((encode_log(parse_legacy_log(log)), cid))
+            except ValueError:
+                skipped += 1
+        conn.executemany("UPDATE chat_conversations SET messages_log=? WHERE id=?", updates)
+        last = rows[-1][0]
+    if skipped:
+        logger.warning(f"{skipped} chat logs could not be parsed and were left as text")
+
+@migration
+def _m005_broadcasts(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        cursor INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT,
+        finished_at TEXT,
+        lease_until REAL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)")
+    # Set when Telegram says the user blocked the bot; broadcasts skip them
+    conn.execute("ALTER TABLE users ADD COLUMN blocked_at TEXT")
+
+@migration
+def _m006_meta(conn):
+    # Small bot-wide settings, e.g. the hash of the command list last sent to Telegram
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+@migration
+def _m007_premium_index(conn):
+    # PremiumIndex.load() reads only the users who have (or had) premium
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_premium ON users (premium_until) WHERE premium_until IS NOT NULL")
+
+@migration
+def _m008_cache_versions(conn):
+    # Bumped by triggers on the writes that cached copies care about (not the message
+    # counters), so workers sharing the database know which cache to drop
+    conn.execute("CREATE TABLE IF NOT EXISTS cache_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("INSERT OR IGNORE INTO cache_versions (name) VALUES ('users'), ('bans'), ('premium')")
+    bump = "UPDATE cache_versions SET version = version + 1 WHERE name IN ({})"
+    for name, event, names in (
+        ("users_profile_changed",
+         "UPDATE OF username, first_name, gender, age, country, country_flag, referral_code, referral_count ON users",
+         "'users'"),
+        ("users_premium_changed", "UPDATE OF premium_until ON users", "'users', 'premium'"),
+        ("users_deleted", "DELETE ON users", "'users', 'premium'"),
+        ("bans_inserted", "INSERT ON bans", "'bans'"),
+        ("bans_updated", "UPDATE ON bans", "'bans'"),
+        ("bans_deleted", "DELETE ON bans", "'bans'"),
+    ):
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} BEGIN {bump.format(names)}; END")
+
+@migration
+def _m009_premium_notices(conn):
+    # The premium_until each user was last told had ended, so only one worker sends the notice
+    conn.execute("CREATE TABLE IF NOT EXISTS premium_notices (user_id INTEGER PRIMARY KEY, premium_until TEXT NOT NULL)")
+
+def migrate():
+    """Bring the database up to date. Safe to run from several workers at once."""
+    conn = get_conn()
+    while True:
+        # BEGIN IMMEDIATE takes the write lock, so concurrent starters apply each step once
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return version
+            step = MIGRATIONS[version]
+            step(conn)
+            conn.execute(f"PRAGMA user_version={version + 1}")
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        logger.info(f"DB migrated to v{version + 1} ({step.__name__})")
 
-def init_db():
+def meta_get(key, default=None):
     with get_conn() as conn:
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            gender TEXT,
-            age INTEGER,
-            country TEXT,
-            country_flag TEXT,
-            messages_sent INTEGER DEFAULT 0,
-            media_approved INTEGER DEFAULT 0,
-            media_rejected INTEGER DEFAULT 0,
-            referral_code TEXT UNIQUE,
-            referral_count INTEGER DEFAULT 0,
-            premium_until TEXT,
-            joined_at TEXT
-        )
-        """)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS bans (
-            user_id INTEGER PRIMARY KEY,
-            ban_until TEXT,
-            permanent INTEGER DEFAULT 0,
-            reason TEXT
-        )
-        """)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS reports (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            reporter_id INTEGER,
-            reported_id INTEGER,
-            timestamp TEXT
-        )
-        """)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS chat_conversations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user1_id INTEGER,
-            user2_id INTEGER,
-            start_time TEXT,
-            end_time TEXT,
-            messages_log TEXT
-        )
-        """)
+        row = conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else default
+
+def meta_set(key, value):
+    with get_conn() as conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
         conn.commit()
 
+def init_db():
+    migrate()
+    if REPORT_RETENTION_DAYS:
+        prune_reports(REPORT_RETENTION_DAYS)
+    ban_index.load()
+    premium_index.load()
+
+# User cache
+class UserCache:
+    """Bounded LRU of user profiles with a TTL, sitting in front of db_user().
+
+    Every write to the users table updates the cached copy in place (or
+    invalidates it), so reads stay correct without touching SQLite. A load
+    that races with a write is not cached: put() only stores a row if no
+    write happened since the caller took its token().
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, uid):
+        with self._lock:
+            item = self._data.get(uid)
+            if item is None:
+                self.misses += 1
+                return None
+            expires, profile = item
+            if expires < time.monotonic():
+                del self._data[uid]
+                self.misses += 1
+                return None
+            self._data.move_to_end(uid)
+            self.hits += 1
+            return dict(profile)
+
+    def token(self):
+        return self._writes
+
+    def put(self, uid, profile, token):
+        with self._lock:
+            if token != self._writes:
+                return
+            self._data[uid] = (time.monotonic() + self.ttl, dict(profile))
+            self._data.move_to_end(uid)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def update(self, uid, **fields):
+        with self._lock:
+            self._writes += 1
+            item = self._data.get(uid)
+            if item:
+                item[1].update(fields)
+
+    def bump(self, uid, field, delta=1):
+        with self._lock:
+            self._writes += 1
+            item = self._data.get(uid)
+            if item:
+                item[1][field] = (item[1][field] or 0) + delta
+
+    def invalidate(self, uid):
+        with self._lock:
+            self._writes += 1
+            self._data.pop(uid, None)
+
+    def clear(self):
+        with self._lock:
+            self._writes += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0
+            }
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# Counters
+STAT_FIELDS = ("messages_sent", "media_approved", "media_rejected")
+
+class CounterBuffer:
+    """Write-behind accumulator for the users-table message/media counters.
+
+    Increments are summed in memory and written as one transaction every
+    `interval_ms`, as soon as `max_pending` increments are waiting, and at
+    exit. Readers add pending() to what the database (or user cache) says.
+    `generation` is odd while a flush is running, so a reader that saw it
+    change knows its two reads may disagree and retries.
+    """
+
+    def __init__(self, interval_ms=2000, max_pending=500):
+        self.interval = interval_ms / 1000
+        self.max_pending = max_pending
+        self.generation = 0
+        self.flushes = 0
+        self.flushed = 0
+        self._pending = {}
+        self._inflight = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, uid, field, delta=1):
+        if field not in STAT_FIELDS:
+            raise ValueError(field)
+        with self._lock:
+            deltas = self._pending.setdefault(uid, {})
+            deltas[field] = deltas.get(field, 0) + delta
+            self._count += 1
+            full = self._count >= self.max_pending
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stat-flush", daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def pending(self, uid):
+        with self._lock:
+            merged = dict(self._inflight.get(uid, ()))
+            for field, delta in self._pending.get(uid, {}).items():
+                merged[field] = merged.get(field, 0) + delta
+            return merged
+
+    def settled(self, generation):
+        if generation % 2 == 0 and generation == self.generation:
+            return True
+        with self._flush_lock:
+            return False
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, count = self._pending, self._count
+                self._pending, self._count = {}, 0
+                self._inflight = batch
+                self.generation += 1
+            try:
+                rows = [(d.get("messages_sent", 0), d.get("media_approved", 0), d.get("media_rejected", 0), uid)
+                        for uid, d in batch.items()]
+                with get_conn() as conn:
+                    conn.executemany("""
+                        UPDATE users SET messages_sent=messages_sent+?, media_approved=media_approved+?,
+                        media_rejected=media_rejected+? WHERE user_id=?
+                    """, rows)
+                    conn.commit()
+                for uid, deltas in batch.items():
+                    for field, delta in deltas.items():
+                        user_cache.bump(uid, field, delta)
+                self.flushes += 1
+                self.flushed += len(rows)
+                return len(rows)
+            except Exception as e:
+                logger.error(f"Counter flush failed, will retry: {e}")
+                with self._lock:
+                    for uid, deltas in batch.items():
+                        mine = self._pending.setdefault(uid, {})
+                        for field, delta in deltas.items():
+                            mine[field] = mine.get(field, 0) + delta
+                    # _count is add() calls, not the sum of their deltas
+                    self._count += count
+                return 0
+            finally:
+                with self._lock:
+                    self._inflight = {}
+                    self.generation += 1
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {"pending": self._count, "users": len(self._pending),
+                    "flushes": self.flushes, "rows_flushed": self.flushed}
+
+stat_buffer = CounterBuffer(STAT_FLUSH_MS, STAT_FLUSH_MAX)
+
 def db_user(uid):
+    if sessions.shared:
+        sync_shared_caches()
+    while True:
+        generation = stat_buffer.generation
+        u = _load_user(uid)
+        if u:
+            for field, delta in stat_buffer.pending(uid).items():
+                u[field] += delta
+        if stat_buffer.settled(generation):
+            return u
+
+def _load_user(uid):
+    u = user_cache.get(uid)
+    if u:
+        return u
+    token = user_cache.token()
     with get_conn() as conn:
         row = conn.execute("""
             SELECT user_id, username, first_name, gender, age, country, country_flag,
@@ -203,12 +899,14 @@ def db_user(uid):
         """, (uid,)).fetchone()
         if not row:
             return None
-        return {
+        u = {
             "user_id": row[0], "username": row[1], "first_name": row[2], "gender": row[3], 
             "age": row[4], "country": row[5], "country_flag": row[6], "messages_sent": row[7],
             "media_approved": row[8], "media_rejected": row[9], "referral_code": row[10],
             "referral_count": row[11], "premium_until": row[12]
         }
+        user_cache.put(uid, u, token)
+        return u
 
 def db_new_user(user):
     uid = user.id
@@ -223,32 +921,146 @@ def db_new_user(user):
         """, (uid, user.username or "", user.first_name or "", None, None, None, None, 
               datetime.utcnow().isoformat(), ref))
         conn.commit()
+    user_cache.invalidate(uid)
 
 def db_set_gender(uid, g):
     with get_conn() as conn:
         conn.execute("UPDATE users SET gender=? WHERE user_id=?", (g, uid))
         conn.commit()
+    user_cache.update(uid, gender=g)
 
 def db_set_age(uid, a):
     with get_conn() as conn:
         conn.execute("UPDATE users SET age=? WHERE user_id=?", (a, uid))
         conn.commit()
+    user_cache.update(uid, age=a)
 
 def db_set_country(uid, c, f):
     with get_conn() as conn:
         conn.execute("UPDATE users SET country=?, country_flag=? WHERE user_id=?", (c, f, uid))
         conn.commit()
+    user_cache.update(uid, country=c, country_flag=f)
+
+# Premium
+def premium_deadline(premium_until):
+    """Epoch seconds a users.premium_until value lasts until, or None if unreadable."""
+    if not premium_until:
+        return None
+    try:
+        return datetime.fromisoformat(premium_until).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+class PremiumIndex:
+    """Premium expiry times held in memory, so is_premium() is a dict lookup.
+
+    Loaded from users.premium_until at startup and updated by set_premium(),
+    remove_premium() and add_referral(). Entries sit in a TTLMap on the wall
+    clock; a scheduler thread sleeps until the earliest one is due and sweeps
+    it. Any write can sweep too, so expired entries are only queued there and
+    the scheduler thread hands each to premium_expired(). Premium that lapsed
+    while the bot was down is dropped on load without a notice.
+    """
+
+    def __init__(self):
+        self._premium = TTLMap(clock=time.time, on_expire=self._expired)
+        self._cond = threading.Condition()
+        self._due = deque()
+        self._thread = None
+        self.loaded = False
+
+    def load(self):
+        now = time.time()
+        premium = TTLMap(clock=time.time, on_expire=self._expired)
+        with get_conn() as conn:
+            rows = conn.execute("SELECT user_id, premium_until FROM users WHERE premium_until IS NOT NULL").fetchall()
+        for uid, until in rows:
+            deadline = premium_deadline(until)
+            if deadline is not None and deadline > now:
+                premium.set(uid, until, deadline=deadline)
+        with self._cond:
+            self._premium = premium
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="premium", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        if not self.loaded:
+            logger.info(f"Premium index loaded: {len(premium)} active")
+        self.loaded = True
+
+    def is_premium(self, uid):
+        if not self.loaded:
+            self.load()
+        return uid in self._premium
+
+    def add(self, uid, premium_until):
+        deadline = premium_deadline(premium_until)
+        if deadline is None:
+            self._premium.discard(uid)
+            return
+        self._premium.set(uid, premium_until, deadline=deadline)
+        with self._cond:
+            self._cond.notify()
+
+    def remove(self, uid):
+        self._premium.discard(uid)
+
+    def stats(self):
+        return self._premium.stats()
+
+    def _expired(self, uid, premium_until):
+        with self._cond:
+            self._due.append((uid, premium_until))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = self._premium.next_deadline()
+                if not self._due:
+                    # Capped so a wall clock jump is noticed within the hour
+                    self._cond.wait(3600 if deadline is None else min(3600, max(0.0, deadline - time.time())))
+                premium = self._premium
+            premium.sweep()
+            while self._due:
+                uid, premium_until = self._due.popleft()
+                try:
+                    premium_expired(uid, premium_until)
+                except Exception:
+                    logger.exception(f"Premium expiry failed: {uid}")
+
+premium_index = PremiumIndex()
+
+def premium_expired(uid, premium_until):
+    # users.premium_until is left as it is; the index already treats it as lapsed. Recording
+    # the notice, only while the column still holds this value, claims it, so with several
+    # workers (or a renewal racing the sweep) the user hears about it once
+    with get_conn() as conn:
+        cur = conn.execute("""
+            INSERT INTO premium_notices (user_id, premium_until)
+            SELECT user_id, premium_until FROM users WHERE user_id=? AND premium_until=?
+            ON CONFLICT(user_id) DO UPDATE SET premium_until=excluded.premium_until
+            WHERE premium_notices.premium_until != excluded.premium_until
+        """, (uid, premium_until))
+        conn.commit()
+    if cur.rowcount != 1:
+        return
+    text = "Your premium ended."
+    if match_queue.remove_filtered(uid):
+        text += " Your filtered search stopped, tap 🔍 Find Someone to keep searching."
+    try:
+        bot.send_message(uid, text + "\nRefer friends to get it again!", reply_markup=main_kb(uid))
+    except:
+        pass
+    logger.info(f"Premium expired: {uid}")
 
 def is_premium(uid):
+    """A lookup in premium_index; takes only the uid and never reads the profile row."""
     if uid == ADMIN_ID:
         return True
-    u = db_user(uid)
-    if not u or not u["premium_until"]:
-        return False
-    try:
-        return datetime.fromisoformat(u["premium_until"]) > datetime.utcnow()
-    except:
-        return False
+    if sessions.shared:
+        sync_shared_caches()
+    return premium_index.is_premium(uid)
 
 def set_premium(uid, until):
     try:
@@ -257,6 +1069,8 @@ def set_premium(uid, until):
         with get_conn() as conn:
             conn.execute("UPDATE users SET premium_until=? WHERE user_id=?", (dt, uid))
             conn.commit()
+        user_cache.update(uid, premium_until=dt)
+        premium_index.add(uid, dt)
         return True
     except:
         return False
@@ -265,13 +1079,25 @@ def remove_premium(uid):
     with get_conn() as conn:
         conn.execute("UPDATE users SET premium_until=NULL WHERE user_id=?", (uid,))
         conn.commit()
+    user_cache.update(uid, premium_until=None)
+    premium_index.remove(uid)
+
+# Bot identity - get_me() once, then again every BOT_INFO_REFRESH_HOURS
+_bot_info = {"user": None, "fetched": 0.0}
+
+def bot_info():
+    if _bot_info["user"] is None or time.monotonic() - _bot_info["fetched"] > BOT_INFO_REFRESH_HOURS * 3600:
+        try:
+            _bot_info["user"] = bot.get_me()
+            _bot_info["fetched"] = time.monotonic()
+        except Exception as e:
+            logger.warning(f"get_me failed: {e}")
+    return _bot_info["user"]
 
 def get_ref_link(uid):
     user = db_user(uid)
-    try:
-        bot_user = bot.get_me().username
-    except:
-        bot_user = None
+    me = bot_info()
+    bot_user = me.username if me else None
     if user and bot_user:
         return f"https://t.me/{bot_user}?start={user['referral_code']}"
     if user:
@@ -282,36 +1108,128 @@ def add_referral(uid):
     with get_conn() as conn:
         conn.execute("UPDATE users SET referral_count=referral_count+1 WHERE user_id=?", (uid,))
         conn.commit()
+        user_cache.bump(uid, "referral_count")
         u = db_user(uid)
         if u and u["referral_count"] >= PREMIUM_REFERRALS_NEEDED:
             until = (datetime.utcnow() + timedelta(hours=PREMIUM_DURATION_HOURS)).isoformat()
             conn.execute("UPDATE users SET premium_until=?, referral_count=0 WHERE user_id=?", (until, uid))
             conn.commit()
+            user_cache.update(uid, premium_until=until, referral_count=0)
+            premium_index.add(uid, until)
             try:
                 bot.send_message(uid, f"Yo! You got premium for {PREMIUM_DURATION_HOURS} hour! 🎉\nEnjoy opposite gender search now.")
             except:
                 pass
 
+def incr_stat(uid, field, delta=1):
+    stat_buffer.add(uid, field, delta)
+
+# Bans
+def ban_deadline(ban_until, permanent):
+    """Epoch seconds a bans row lasts until: inf if permanent, None if it never applied."""
+    if permanent:
+        return math.inf
+    if not ban_until:
+        return None
+    try:
+        return datetime.fromisoformat(ban_until).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+class BanIndex:
+    """Active bans held in memory so is_banned() is a dict lookup.
+
+    Loaded from the bans table at startup and updated by ban_user() and
+    unban_user(). Temp bans sit in a TTLMap on the wall clock, so they stop
+    counting the moment ban_until passes and are swept off its heap.
+    """
+
+    def __init__(self):
+        self._bans = TTLMap(clock=time.time)
+        self.loaded = False
+
+    def _read_table(self):
+        now = time.time()
+        with get_conn() as conn:
+            rows = conn.execute("SELECT user_id, ban_until, permanent FROM bans").fetchall()
+        active = {}
+        for uid, until, perm in rows:
+            deadline = ban_deadline(until, perm)
+            if deadline is not None and deadline > now:
+                active[uid] = deadline
+        return active
+
+    def load(self):
+        bans = TTLMap(clock=time.time)
+        for uid, deadline in self._read_table().items():
+            bans.set(uid, True, deadline=deadline)
+        self._bans = bans
+        if not self.loaded:
+            logger.info(f"Ban index loaded: {len(bans)} active bans")
+        self.loaded = True
+
+    def is_banned(self, uid):
+        if not self.loaded:
+            self.load()
+        return uid in self._bans
+
+    def add(self, uid, deadline):
+        if deadline is None:
+            self._bans.discard(uid)
+        else:
+            self._bans.set(uid, True, deadline=deadline)
+
+    def remove(self, uid):
+        self._bans.discard(uid)
+
+    def check(self):
+        """Compare with the bans table. Returns (missing from index, extra in index)."""
+        table = set(self._read_table())
+        index = {uid for uid, _ in self._bans.items()}
+        return sorted(table - index), sorted(index - table)
+
+    def stats(self):
+        return self._bans.stats()
+
+ban_index = BanIndex()
+
+# With a shared session backend other workers write the same database, so the
+# user cache, ban index and premium index are dropped when their row in cache_versions
+# moves (checked at most every CACHE_SYNC_SECONDS). The counter flush doesn't bump them
+_cache_sync = {"checked": 0.0, "versions": None}
+_cache_sync_lock = threading.Lock()
+
+def sync_shared_caches():
+    now = time.monotonic()
+    if now - _cache_sync["checked"] < CACHE_SYNC_SECONDS:
+        return
+    with _cache_sync_lock:
+        if now - _cache_sync["checked"] < CACHE_SYNC_SECONDS:
+            return
+        _cache_sync["checked"] = now
+        versions = dict(get_conn().execute("SELECT name, version FROM cache_versions").fetchall())
+        seen = _cache_sync["versions"]
+        _cache_sync["versions"] = versions
+    if seen is None:
+        return
+    if versions.get("users") != seen.get("users"):
+        user_cache.clear()
+    if versions.get("bans") != seen.get("bans"):
+        ban_index.load()
+    if versions.get("premium") != seen.get("premium"):
+        premium_index.load()
+
 def is_banned(uid):
     if uid == ADMIN_ID:
         return False
-    with get_conn() as conn:
-        row = conn.execute("SELECT ban_until, permanent FROM bans WHERE user_id=?", (uid,)).fetchone()
-        if not row:
-            return False
-        ban_until, perm = row
-        if perm:
-            return True
-        if ban_until:
-            try:
-                return datetime.fromisoformat(ban_until) > datetime.utcnow()
-            except:
-                return False
-        return False
+    if sessions.shared:
+        sync_shared_caches()
+    return ban_index.is_banned(uid)
 
 def ban_user(uid, hours=None, perm=False, reason=""):
     with get_conn() as conn:
         if perm:
+            until = None
             conn.execute("INSERT OR REPLACE INTO bans (user_id, ban_until, permanent, reason) VALUES (?, ?, ?, ?)",
                          (uid, None, 1, reason))
         else:
@@ -319,22 +1237,61 @@ def ban_user(uid, hours=None, perm=False, reason=""):
             conn.execute("INSERT OR REPLACE INTO bans (user_id, ban_until, permanent, reason) VALUES (?, ?, ?, ?)",
                          (uid, until, 0, reason))
         conn.commit()
+    ban_index.add(uid, ban_deadline(until, perm))
 
 def unban_user(uid):
     with get_conn() as conn:
         conn.execute("DELETE FROM bans WHERE user_id=?", (uid,))
         conn.commit()
+    ban_index.remove(uid)
+
+# Reports - report_counts holds each user's score, so threshold checks are one
+# primary-key read and the raw reports table is only an audit log
+def _decayed(score, updated, now):
+    if not REPORT_DECAY_HOURS or not score:
+        return score
+    return score * 0.5 ** ((now - updated) / (REPORT_DECAY_HOURS * 3600))
 
 def count_reports(uid):
     with get_conn() as conn:
-        row = conn.execute("SELECT COUNT(*) FROM reports WHERE reported_id=?", (uid,)).fetchone()
-        return row[0] if row else 0
+        row = conn.execute("SELECT score, updated FROM report_counts WHERE user_id=?", (uid,)).fetchone()
+    return int(_decayed(row[0], row[1], time.time()) + 1e-9) if row else 0
 
 def add_report(reporter, reported):
-    with get_conn() as conn:
+    """Log a report and return the reported user's count after it."""
+    now = time.time()
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
         conn.execute("INSERT INTO reports (reporter_id, reported_id, timestamp) VALUES (?, ?, ?)",
-                    (reporter, reported, datetime.utcnow().isoformat()))
+                     (reporter, reported, datetime.utcnow().isoformat()))
+        seen = conn.execute("SELECT last_at FROM report_dedup WHERE reporter_id=? AND reported_id=?",
+                            (reporter, reported)).fetchone()
+        row = conn.execute("SELECT score, updated FROM report_counts WHERE user_id=?", (reported,)).fetchone()
+        score = _decayed(row[0], row[1], now) if row else 0.0
+        if not (REPORT_DEDUP_HOURS and seen and now - seen[0] < REPORT_DEDUP_HOURS * 3600):
+            score += 1
+            conn.execute("INSERT OR REPLACE INTO report_counts (user_id, score, updated) VALUES (?, ?, ?)",
+                         (reported, score, now))
+            conn.execute("INSERT OR REPLACE INTO report_dedup (reporter_id, reported_id, last_at) VALUES (?, ?, ?)",
+                         (reporter, reported, now))
         conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return int(score + 1e-9)
+
+def prune_reports(days):
+    """Drop raw reports older than `days`; ban decisions only read report_counts."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    with get_conn() as conn:
+        gone = conn.execute("DELETE FROM reports WHERE timestamp < ?", (cutoff.isoformat(),)).rowcount
+        if REPORT_DEDUP_HOURS:
+            conn.execute("DELETE FROM report_dedup WHERE last_at < ?", (time.time() - REPORT_DEDUP_HOURS * 3600,))
+        conn.commit()
+    if gone:
+        logger.info(f"Pruned {gone} reports older than {days} days")
+    return gone
 
 # Helpers
 def resolve_id(ident):
@@ -360,25 +1317,22 @@ def resolve_id(ident):
 def has_bad_content(text):
     if not text:
         return False
-    if LINK_PATTERN.search(text):
-        return True
-    for p in BANNED_PATTERNS:
-        if p.search(text):
-            return True
-    return False
+    return moderation.search(text)
 
 def remove_queues(uid):
-    global waiting_random, waiting_opposite
-    if uid in waiting_random:
-        waiting_random.remove(uid)
-    waiting_opposite = [(u, g) for u, g in waiting_opposite if u != uid]
+    match_queue.remove(uid)
 
 def save_msg(uid, cid, mid):
-    if uid not in chat_history:
-        chat_history[uid] = []
-    chat_history[uid].append((cid, mid))
-    if len(chat_history[uid]) > 50:
-        chat_history[uid].pop(0)
+    chat_history.save(uid, cid, mid)
+
+def relay(uid, partner, send, payload, stat, count=1):
+    """Queue chat content for partner without waiting on it; uid hears "Couldn't send" if it fails."""
+    def done(future):
+        if future.exception():
+            outbox.submit(_unqueued["send_message"], uid, "Couldn't send")
+        else:
+            incr_stat(uid, stat, count)
+    outbox.submit(send, partner, payload, priority=PRIORITY_RELAY).add_done_callback(done)
 
 def user_name(uid):
     u = db_user(uid)
@@ -397,80 +1351,85 @@ def partner_msg(partner, viewer):
     return msg
 
 # Matching
+def enqueue_search(uid, u, opposite=False, prefs=None):
+    if not u:
+        return match_queue.enqueue(uid, None)
+    return match_queue.enqueue(uid, u["gender"], opposite=opposite, country=u["country"], age=u["age"], prefs=prefs)
+
+def _match_notified(u1, u2):
+    def done(future):
+        if future.exception():
+            logger.error(f"Match notify failed {u1} <-> {u2}: {future.exception()}")
+    return done
+
+@MATCH_LATENCY.time()
 def match_users():
-    global waiting_random, waiting_opposite, active_pairs
-    
-    i = 0
-    while i < len(waiting_opposite):
-        uid, gender = waiting_opposite[i]
-        opp = "Male" if gender == "Female" else "Female"
-        match_idx = None
-        for j, other in enumerate(waiting_random):
-            # SKIP ADMIN - ADMIN INVISIBLE
-            if other == ADMIN_ID:
-                continue
-            other_data = db_user(other)
-            if other_data and other_data['gender'] == opp:
-                match_idx = j
-                break
-        if match_idx is not None:
-            found = waiting_random.pop(match_idx)
-            waiting_opposite.pop(i)
-            active_pairs[uid] = found
-            active_pairs[found] = uid
-            u1 = db_user(uid)
-            u2 = db_user(found)
-            bot.send_message(uid, partner_msg(u2, uid), reply_markup=chat_kb())
-            bot.send_message(found, partner_msg(u1, found), reply_markup=chat_kb())
-            logger.info(f"Matched {uid} <-> {found}")
-            return
-        else:
-            i += 1
-    
-    while len(waiting_random) >= 2:
-        # SKIP ADMIN FROM RANDOM MATCHING
-        non_admin = [u for u in waiting_random if u != ADMIN_ID]
-        if len(non_admin) < 2:
-            break
-        
-        u1 = non_admin.pop(0)
-        u2 = non_admin.pop(0)
-        
-        # Remove from original list
-        waiting_random.remove(u1)
-        waiting_random.remove(u2)
-        
-        active_pairs[u1] = u2
-        active_pairs[u2] = u1
-        u1_data = db_user(u1)
-        u2_data = db_user(u2)
-        bot.send_message(u1, partner_msg(u2_data, u1), reply_markup=chat_kb())
-        bot.send_message(u2, partner_msg(u1_data, u2), reply_markup=chat_kb())
-        logger.info(f"Random match {u1} <-> {u2}")
-
-# Keyboards
-def main_kb(uid):
+    pairs = sessions.claim_matches()
+    # Every pair is already in active_pairs, so each one gets its message even if another's fails
+    for u1, u2 in pairs:
+        try:
+            texts = ((u1, partner_msg(db_user(u2), u1)), (u2, partner_msg(db_user(u1), u2)))
+        except Exception as e:
+            logger.error(f"Match profile lookup failed {u1} <-> {u2}: {e}")
+            texts = ((u1, "Great! Found someone:\n\nLet's chat!"), (u2, "Great! Found someone:\n\nLet's chat!"))
+        # Queued without waiting: one thread matches for everybody, so it can't sit on each send
+        for uid, text in texts:
+            try:
+                outbox.submit(_unqueued["send_message"], uid, text,
+                              reply_markup=chat_kb()).add_done_callback(_match_notified(u1, u2))
+            except Exception as e:
+                logger.error(f"Match notify failed {u1} <-> {u2}: {e}")
+        logger.info(f"Matched {u1} <-> {u2}")
+    return pairs, sessions.last_waits
+
+def match_pass_done(pairs, waits):
+    MATCH_PAIRS.inc(amount=len(pairs))
+    for wait in waits:
+        MATCH_WAIT.observe(wait)
+    last = match_scheduler.last
+    logger.info(f"Match pass: {len(pairs)} pairs, wait p50 {last['wait_p50']:.1f}s p95 {last['wait_p95']:.1f}s")
+
+# Handlers only enqueue and notify(); one thread pairs everyone it can per pass
+match_scheduler = MatchScheduler(match_users, tick=MATCH_TICK_MS / 1000,
+                                 waiting=lambda: len(match_queue), on_pass=match_pass_done)
+
+# Keyboards - every variant is built and serialised once at import; main_kb() and
+# main_inline_kb() only pick one, from a single cached profile read
+class PrebuiltMarkup(types.JsonSerializable):
+    """A reply_markup whose JSON is computed once and reused for every send."""
+
+    def __init__(self, markup):
+        self.markup = markup
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+def kb_variant(uid):
+    """"new" until the user has a gender, then "premium" or "free"."""
+    u = db_user(uid)
+    if not u or not u["gender"]:
+        return "new"
+    return "premium" if is_premium(uid) else "free"
+
+def _build_main_kb(variant):
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
     kb.add("🔍 Find Someone")
-    u = db_user(uid)
-    if u and u["gender"]:
-        if is_premium(uid):
-            kb.add("💕 Find Opposite Gender")
-        else:
-            kb.add("💎 Opposite Gender (Premium)")
+    if variant == "premium":
+        kb.add("💕 Find Opposite Gender")
+    elif variant == "free":
+        kb.add("💎 Opposite Gender (Premium)")
     kb.add("❌ Stop")
     kb.add("⚙️ Settings", "👥 Refer")
     return kb
 
-def main_inline_kb(uid):
+def _build_main_inline_kb(variant):
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(types.InlineKeyboardButton("🔍 Find Someone", callback_data="act:search"))
-    u = db_user(uid)
-    if u and u["gender"]:
-        if is_premium(uid):
-            markup.add(types.InlineKeyboardButton("💕 Opposite Gender", callback_data="act:opp"))
-        else:
-            markup.add(types.InlineKeyboardButton("💎 Premium", callback_data="act:premium"))
+    if variant == "premium":
+        markup.add(types.InlineKeyboardButton("💕 Opposite Gender", callback_data="act:opp"))
+    elif variant == "free":
+        markup.add(types.InlineKeyboardButton("💎 Premium", callback_data="act:premium"))
     markup.row(
         types.InlineKeyboardButton("⚙️ Settings", callback_data="act:settings"),
         types.InlineKeyboardButton("👥 Refer", callback_data="act:refer")
@@ -478,17 +1437,35 @@ def main_inline_kb(uid):
     markup.row(types.InlineKeyboardButton("❌ Stop", callback_data="act:stop"))
     return markup
 
-def chat_kb():
+def _build_chat_kb():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
     kb.add("👤 Info")
     kb.add("➡️ Next", "❌ Stop")
     return kb
 
-def report_kb():
+def _build_report_kb():
     markup = types.InlineKeyboardMarkup(row_width=1)
     markup.add(types.InlineKeyboardButton("Report This Person", callback_data="rep:confirm"))
     return markup
 
+KB_VARIANTS = ("new", "free", "premium")
+MAIN_KB = {v: PrebuiltMarkup(_build_main_kb(v)) for v in KB_VARIANTS}
+MAIN_INLINE_KB = {v: PrebuiltMarkup(_build_main_inline_kb(v)) for v in KB_VARIANTS}
+CHAT_KB = PrebuiltMarkup(_build_chat_kb())
+REPORT_KB = PrebuiltMarkup(_build_report_kb())
+
+def main_kb(uid):
+    return MAIN_KB[kb_variant(uid)]
+
+def main_inline_kb(uid):
+    return MAIN_INLINE_KB[kb_variant(uid)]
+
+def chat_kb():
+    return CHAT_KB
+
+def report_kb():
+    return REPORT_KB
+
 # Flask
 @app.route("/")
 def home():
@@ -496,13 +1473,92 @@ def home():
 
 @app.route("/health")
 def health():
-    return {"ok": True}, 200
+    return {"ok": True, "user_cache": user_cache.stats(), "stat_buffer": stat_buffer.stats(),
+            "outbox": outbox.stats(), "chat_history": chat_history.stats(),
+            "sessions": {
+                "backend": SESSION_BACKEND,
+                "pending_media": pending_media.stats(),
+                "report_reason_pending": report_reason_pending.stats(),
+                "pending_country": pending_country.stats(),
+                "last_partner_disconnect": last_partner_disconnect.stats(),
+            },
+            "bans": ban_index.stats(), "premium": premium_index.stats(), "albums": albums.stats(),
+            "matching": match_scheduler.stats()}, 200
+
+class UpdateWorkers:
+    """Bounded pool that runs webhook updates off the request thread.
+
+    At most `workers` updates run at once and `max_queued` more may wait;
+    beyond that submit() refuses, and the webhook answers 503 so Telegram
+    redelivers later instead of us queueing without limit.
+    """
+
+    def __init__(self, workers, max_queued):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="update")
+        self._slots = threading.BoundedSemaphore(workers + max_queued)
+        self.rejected = 0
+
+    def submit(self, update):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            return False
+        self._pool.submit(self._run, update)
+        return True
+
+    def _run(self, update):
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f"Update {update.update_id} failed: {e}")
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+update_workers = UpdateWorkers(WEBHOOK_WORKERS, WEBHOOK_QUEUE)
+
+metrics.gauge("ghosttalk_active_chats", "Users currently in a chat", lambda: len(active_pairs))
+metrics.gauge("ghosttalk_waiting_users", "Users waiting for a match", lambda: match_queue.stats(), ("queue",))
+metrics.gauge("ghosttalk_pending_media", "Media waiting for consent", lambda: len(pending_media))
+metrics.gauge("ghosttalk_reconnect_entries", "Reconnect offers still open", lambda: len(last_partner_disconnect))
+metrics.gauge("ghosttalk_history_users", "Users with chat history kept", lambda: chat_history.stats()["users"])
+metrics.gauge("ghosttalk_history_bytes", "Memory held by chat history", lambda: chat_history.stats()["bytes"])
+metrics.gauge("ghosttalk_user_cache_size", "Profiles in the user cache", lambda: user_cache.stats()["size"])
+metrics.gauge("ghosttalk_user_cache_lookups_total", "User cache lookups",
+              lambda: {"hit": user_cache.hits, "miss": user_cache.misses}, ("result",), type="counter")
+metrics.gauge("ghosttalk_stat_buffer_pending", "Counter increments not yet written", lambda: stat_buffer.stats()["pending"])
+metrics.gauge("ghosttalk_outbox_depth", "Sends queued or in flight", outbox.depth)
+metrics.gauge("ghosttalk_outbox_events_total", "Outbox send outcomes",
+              lambda: {"sent": outbox.sent, "failed": outbox.failed, "retried": outbox.retried,
+                       "throttled": outbox.throttled}, ("event",), type="counter")
+metrics.gauge("ghosttalk_active_bans", "Bans in the ban index", lambda: ban_index.stats()["size"])
+metrics.gauge("ghosttalk_premium_users", "Users in the premium index", lambda: premium_index.stats()["size"])
+metrics.gauge("ghosttalk_db_connections", "Open pooled SQLite connections", lambda: db_pool.stats()["open"])
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route(WEBHOOK_PATH, methods=["POST"])
+def webhook():
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return "Forbidden", 403
+    try:
+        update = types.Update.de_json(request.get_data(as_text=True))
+    except Exception:
+        return "Bad update", 400
+    if not update_workers.submit(update):
+        return "Busy", 503
+    return "", 200
 
 # Commands
 @bot.message_handler(commands=['start'])
 def cmd_start(m):
     user = m.from_user
     db_new_user(user)
+    clear_blocked(user.id)
     
     if is_banned(user.id):
         bot.send_message(user.id, "You're banned lol")
@@ -725,15 +1781,12 @@ def cmd_search(m):
     if uid in active_pairs:
         bot.send_message(uid, "Already chatting! Use /next")
         return
-    in_random = uid in waiting_random
-    in_opposite = any(uid == w[0] for w in waiting_opposite)
-    if in_random or in_opposite:
+    if match_queue.is_waiting(uid):
         bot.send_message(uid, "Already searching. Use /stop to cancel")
         return
-    remove_queues(uid)
-    waiting_random.append(uid)
+    enqueue_search(uid, u)
     bot.send_message(uid, "Finding someone... hold on")
-    match_users()
+    match_scheduler.notify()
 
 @bot.message_handler(commands=['search_opposite_gender'])
 def cmd_search_opp(m):
@@ -751,15 +1804,75 @@ def cmd_search_opp(m):
     if uid in active_pairs:
         bot.send_message(uid, "Already chatting!")
         return
-    in_random = uid in waiting_random
-    in_opposite = any(uid == w[0] for w in waiting_opposite)
-    if in_random or in_opposite:
+    if match_queue.is_waiting(uid):
         bot.send_message(uid, "Already searching!")
         return
-    remove_queues(uid)
-    waiting_opposite.append((uid, u["gender"]))
+    enqueue_search(uid, u, opposite=True)
     bot.send_message(uid, "Finding opposite gender... one sec")
-    match_users()
+    match_scheduler.notify()
+
+FILTER_USAGE = ("Usage: /filter [country | same] [min-max] [opposite]\n"
+                "Like: /filter same 18-25, /filter India, /filter 20-30 opposite")
+
+def parse_filter(words, u):
+    """Prefs from /filter arguments, or None if they don't make sense."""
+    gender = country = ages = None
+    rest = []
+    for word in words:
+        span = re.fullmatch(r"(\d{1,2})-(\d{1,2})", word)
+        if span:
+            lo, hi = sorted(int(x) for x in span.groups())
+            if lo < 12 or hi > 99:
+                return None
+            ages = (lo, hi)
+        elif word.lower() == "opposite":
+            gender = OPPOSITE.get(u["gender"])
+            if gender is None:
+                return None
+        else:
+            rest.append(word)
+    if rest:
+        name = " ".join(rest)
+        if name.lower() in ("same", "mine"):
+            country = u["country"]
+        else:
+            info = get_country_info(name)
+            if not info:
+                return None
+            country = info[0]
+    if not (gender or country or ages):
+        return None
+    return Prefs(gender, country, ages)
+
+@bot.message_handler(commands=['filter'])
+def cmd_filter(m):
+    uid = m.from_user.id
+    if is_banned(uid):
+        bot.send_message(uid, "You're banned")
+        return
+    if not is_premium(uid):
+        bot.send_message(uid, "Premium only. Refer friends to unlock!")
+        return
+    u = db_user(uid)
+    if not u or not u["gender"] or not u["age"] or not u["country"]:
+        bot.send_message(uid, "Finish profile first")
+        return
+    if uid in active_pairs:
+        bot.send_message(uid, "Already chatting!")
+        return
+    if match_queue.is_waiting(uid):
+        bot.send_message(uid, f"Already searching ({match_queue.prefs(uid).describe()}). Use /stop to cancel")
+        return
+    prefs = parse_filter(m.text.split()[1:], u)
+    if prefs is None:
+        bot.send_message(uid, FILTER_USAGE)
+        return
+    enqueue_search(uid, u, prefs=prefs)
+    text = f"Finding someone {prefs.describe()}... one sec"
+    if MATCH_WIDEN_SECONDS and (prefs.country or prefs.ages):
+        text += f"\nNobody like that around? The filter loosens every {MATCH_WIDEN_SECONDS}s."
+    bot.send_message(uid, text)
+    match_scheduler.notify()
 
 @bot.message_handler(commands=['stop'])
 def cmd_stop(m):
@@ -776,26 +1889,19 @@ def cmd_next(m):
         return
     disc_user(uid)
     bot.send_message(uid, "Next one coming...", reply_markup=main_kb(uid))
-    waiting_random.append(uid)
-    match_users()
+    enqueue_search(uid, db_user(uid))
+    match_scheduler.notify()
 
 @bot.message_handler(commands=['reconnect'])
 def cmd_reconnect(m):
     uid = m.from_user.id
     
-    if uid not in last_partner_disconnect:
-        bot.send_message(uid, "No one to reconnect with")
+    # Entries drop out of last_partner_disconnect once the reconnect window passes
+    pdata = last_partner_disconnect.get(uid)
+    if not pdata:
+        bot.send_message(uid, f"No one to reconnect with (only works {RECONNECT_WINDOW_MINUTES} min after a chat)")
         return
-    
-    pdata = last_partner_disconnect[uid]
     partner = pdata["partner_id"]
-    disc_time = pdata["disconnect_time"]
-    
-    elapsed = (datetime.utcnow() - disc_time).total_seconds() / 60
-    if elapsed > RECONNECT_WINDOW_MINUTES:
-        bot.send_message(uid, "Window expired. Find someone new!")
-        del last_partner_disconnect[uid]
-        return
     
     p = db_user(partner)
     if not p:
@@ -837,8 +1943,7 @@ def recon_reply(call):
         return
     
     if action == "accept":
-        active_pairs[requester] = responder
-        active_pairs[responder] = requester
+        sessions.pair(requester, responder)
         
         try:
             bot.send_message(requester, "They said yes! 🔥", reply_markup=chat_kb())
@@ -852,8 +1957,7 @@ def recon_reply(call):
         except:
             pass
         
-        if requester in last_partner_disconnect:
-            del last_partner_disconnect[requester]
+        last_partner_disconnect.pop(requester, None)
 
 @bot.message_handler(commands=['report'])
 def cmd_report(m):
@@ -865,8 +1969,7 @@ def cmd_report(m):
     if not partner:
         bot.send_message(uid, "No one to report")
         return
-    add_report(uid, partner)
-    cnt = count_reports(partner)
+    cnt = add_report(uid, partner)
     if cnt >= REPORTS_FOR_BAN:
         ban_user(partner, hours=TEMP_BAN_HOURS, reason="Too many reports")
         try:
@@ -891,8 +1994,7 @@ def report(call):
     _, action = call.data.split(":")
     
     if action == "confirm":
-        add_report(uid, partner)
-        cnt = count_reports(partner)
+        cnt = add_report(uid, partner)
         
         if cnt >= REPORTS_FOR_BAN:
             ban_user(partner, hours=TEMP_BAN_HOURS, reason="Too many reports")
@@ -906,38 +2008,28 @@ def report(call):
         bot.answer_callback_query(call.id, "Reported")
 
 def disc_user(uid):
-    global active_pairs, last_partner_disconnect
-    if uid in active_pairs:
-        partner = active_pairs[uid]
-        
+    # unpair() is atomic, so only one caller gets the partner when both sides leave at once
+    partner = sessions.unpair(uid)
+    if partner is not None:
         if uid in chat_history:
-            msgs_json = str(chat_history[uid])
+            msgs_log = encode_log(chat_history.get(uid))
             with get_conn() as conn:
                 conn.execute("""
                     INSERT INTO chat_conversations (user1_id, user2_id, start_time, end_time, messages_log)
                     VALUES (?, ?, ?, ?, ?)
-                """, (uid, partner, datetime.utcnow().isoformat(), datetime.utcnow().isoformat(), msgs_json))
+                """, (uid, partner, datetime.utcnow().isoformat(), datetime.utcnow().isoformat(), msgs_log))
                 conn.commit()
         
         # ✅ STORE RECONNECT DATA - DONO KO
         last_partner_disconnect[uid] = {
             "partner_id": partner,
-            "disconnect_time": datetime.utcnow()
+            "disconnect_time": datetime.utcnow().isoformat()
         }
         last_partner_disconnect[partner] = {
             "partner_id": uid,
-            "disconnect_time": datetime.utcnow()
+            "disconnect_time": datetime.utcnow().isoformat()
         }
         
-        try:
-            del active_pairs[partner]
-        except:
-            pass
-        try:
-            del active_pairs[uid]
-        except:
-            pass
-        
         markup_uid = types.InlineKeyboardMarkup()
         markup_uid.add(types.InlineKeyboardButton("Report This Person", callback_data=f"report_req:{partner}"))
         
@@ -971,8 +2063,7 @@ def report_req(call):
             return
         
         # ADD REPORT
-        add_report(reporter, reported)
-        cnt = count_reports(reported)
+        cnt = add_report(reporter, reported)
         
         # FETCH REPORTED USER DATA
         reported_user = db_user(reported)
@@ -1016,11 +2107,12 @@ Total Reports: {cnt}/{REPORTS_FOR_BAN}
             pass
         
         # FORWARD CHAT HISTORY IF EXISTS
-        if reported in chat_history and len(chat_history[reported]) > 0:
+        reported_msgs = chat_history.get(reported)
+        if reported_msgs:
             try:
-                bot.send_message(ADMIN_ID, f"\n📝 Chat Messages ({len(chat_history[reported])} total):")
+                bot.send_message(ADMIN_ID, f"\n📝 Chat Messages ({len(reported_msgs)} total):")
                 # Show last 10 messages
-                for cid, mid in chat_history[reported][-10:]:
+                for cid, mid in reported_msgs[-10:]:
                     try:
                         bot.forward_message(ADMIN_ID, cid, mid)
                     except:
@@ -1065,30 +2157,19 @@ def handle_media(m):
     else:
         return
     
+    if m.media_group_id:
+        # Album parts arrive as separate updates; relay_album() gets them all at once
+        albums.add(m.media_group_id, (uid, partner, mtype, mid))
+        return
+    
     u = db_user(uid)
     if u and u["media_approved"]:
-        try:
-            if mtype == "photo":
-                bot.send_photo(partner, mid)
-            elif mtype == "document":
-                bot.send_document(partner, mid)
-            elif mtype == "video":
-                bot.send_video(partner, mid)
-            elif mtype == "animation":
-                bot.send_animation(partner, mid)
-            elif mtype == "sticker":
-                bot.send_sticker(partner, mid)
-            elif mtype == "audio":
-                bot.send_audio(partner, mid)
-            elif mtype == "voice":
-                bot.send_voice(partner, mid)
-            with get_conn() as conn:
-                conn.execute("UPDATE users SET media_approved=media_approved+1 WHERE user_id=?", (uid,))
-                conn.commit()
-        except:
-            bot.send_message(uid, "Couldn't send")
+        relay(uid, partner, _unqueued["send_" + mtype], mid, "media_approved")
         return
     
+    ask_media_consent(uid, partner, mtype, mid)
+
+def ask_media_consent(uid, partner, mtype, mid=None, items=None):
     for token, meta in list(pending_media.items()):
         try:
             if meta.get("sender") == uid and meta.get("partner") == partner:
@@ -1098,10 +2179,13 @@ def handle_media(m):
             continue
     
     token = f"{uid}{int(time.time()*1000)}{secrets.token_hex(4)}"
-    pending_media[token] = {
+    meta = {
         "sender": uid, "partner": partner, "media_type": mtype, 
         "file_id": mid, "timestamp": datetime.utcnow().isoformat()
     }
+    if items:
+        meta["items"] = items
+    pending_media[token] = meta
     
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(
@@ -1110,13 +2194,42 @@ def handle_media(m):
     )
     
     try:
-        msg = bot.send_message(partner, f"They want to send {mtype}. Cool?", reply_markup=markup)
-        pending_media[token]["consent_msg_id"] = msg.message_id
+        what = f"an album ({len(items)} items)" if items else mtype
+        msg = bot.send_message(partner, f"They want to send {what}. Cool?", reply_markup=markup)
+        # Stored values are copies in a shared backend, so write the change back
+        meta = pending_media.get(token)
+        if meta:
+            meta["consent_msg_id"] = msg.message_id
+            pending_media[token] = meta
         bot.send_message(uid, "Waiting for their answer...")
     except:
         bot.send_message(uid, "Couldn't ask")
         pending_media.pop(token, None)
 
+ALBUM_MEDIA = {"photo": types.InputMediaPhoto, "video": types.InputMediaVideo,
+               "document": types.InputMediaDocument, "audio": types.InputMediaAudio}
+
+def album_media(items):
+    return [ALBUM_MEDIA[mtype](file_id) for mtype, file_id in items]
+
+def relay_album(group_id, parts):
+    uid, partner = parts[0][0], parts[0][1]
+    if active_pairs.get(uid) != partner:
+        return  # chat ended while the album was arriving
+    items = [(mtype, mid) for _, _, mtype, mid in parts if mtype in ALBUM_MEDIA]
+    if not items:
+        return
+    u = db_user(uid)
+    if u and u["media_approved"]:
+        relay(uid, partner, _unqueued["send_media_group"], album_media(items), "media_approved", len(items))
+        return
+    ask_media_consent(uid, partner, "album", items=items)
+
+def album_failed(group_id, parts):
+    outbox.submit(_unqueued["send_message"], parts[0][0], "Couldn't send")
+
+albums = AlbumBuffer(relay_album, window=ALBUM_WINDOW_MS / 1000, on_error=album_failed)
+
 @bot.callback_query_handler(func=lambda c: c.data.startswith("app:"))
 def approve_media(call):
     try:
@@ -1132,20 +2245,22 @@ def approve_media(call):
         cmid = meta.get("consent_msg_id")
         
         try:
-            if mtype == "photo":
-                bot.send_photo(call.message.chat.id, mid)
+            if mtype == "album":
+                bot.send_media_group(call.message.chat.id, album_media(meta["items"]), priority=PRIORITY_RELAY)
+            elif mtype == "photo":
+                bot.send_photo(call.message.chat.id, mid, priority=PRIORITY_RELAY)
             elif mtype == "document":
-                bot.send_document(call.message.chat.id, mid)
+                bot.send_document(call.message.chat.id, mid, priority=PRIORITY_RELAY)
             elif mtype == "video":
-                bot.send_video(call.message.chat.id, mid)
+                bot.send_video(call.message.chat.id, mid, priority=PRIORITY_RELAY)
             elif mtype == "animation":
-                bot.send_animation(call.message.chat.id, mid)
+                bot.send_animation(call.message.chat.id, mid, priority=PRIORITY_RELAY)
             elif mtype == "sticker":
-                bot.send_sticker(call.message.chat.id, mid)
+                bot.send_sticker(call.message.chat.id, mid, priority=PRIORITY_RELAY)
             elif mtype == "audio":
-                bot.send_audio(call.message.chat.id, mid)
+                bot.send_audio(call.message.chat.id, mid, priority=PRIORITY_RELAY)
             elif mtype == "voice":
-                bot.send_voice(call.message.chat.id, mid)
+                bot.send_voice(call.message.chat.id, mid, priority=PRIORITY_RELAY)
         except:
             try:
                 bot.send_message(call.message.chat.id, "Couldn't send")
@@ -1156,9 +2271,7 @@ def approve_media(call):
             bot.answer_callback_query(call.id, "Error", show_alert=True)
             return
         
-        with get_conn() as conn:
-            conn.execute("UPDATE users SET media_approved=media_approved+1 WHERE user_id=?", (sender,))
-            conn.commit()
+        incr_stat(sender, "media_approved", len(meta["items"]) if mtype == "album" else 1)
         
         try:
             bot.send_message(sender, "They said yes! ✓")
@@ -1190,9 +2303,7 @@ def reject_media(call):
         
         try:
             bot.send_message(sender, "They said nope")
-            with get_conn() as conn:
-                conn.execute("UPDATE users SET media_rejected=media_rejected+1 WHERE user_id=?", (sender,))
-                conn.commit()
+            incr_stat(sender, "media_rejected")
         except:
             pass
         
@@ -1209,8 +2320,7 @@ def handler(m):
     if uid in report_reason_pending:
         reported = report_reason_pending.pop(uid, None)
         if reported:
-            add_report(uid, reported)
-            cnt = count_reports(reported)
+            cnt = add_report(uid, reported)
             
             if cnt >= REPORTS_FOR_BAN:
                 ban_user(reported, hours=TEMP_BAN_HOURS, reason="Too many")
@@ -1295,24 +2405,6 @@ def handler(m):
         cmd_refer(m)
         return
     
-    @bot.callback_query_handler(func=lambda c: c.data.startswith("act:"))
-    def action_handler(call):
-        uid = call.from_user.id
-        _, action = call.data.split(":")
-        
-        if action == "search":
-            cmd_search(call.message)
-        elif action == "opp":
-            cmd_search_opp(call.message)
-        elif action == "premium":
-            bot.answer_callback_query(call.id, "Refer 3 friends to get premium!")
-        elif action == "settings":
-            cmd_settings(call.message)
-        elif action == "refer":
-            cmd_refer(call.message)
-        elif action == "stop":
-            cmd_stop(call.message)
-    
     if has_bad_content(text):
         bot.send_message(uid, "No bad words or links bro")
         return
@@ -1321,15 +2413,223 @@ def handler(m):
         partner = active_pairs[uid]
         save_msg(uid, m.chat.id, m.message_id)
         save_msg(partner, m.chat.id, m.message_id)
+        relay(uid, partner, _unqueued["send_message"], text, "messages_sent")
+    else:
+        bot.send_message(uid, "Not connected. Search someone", reply_markup=main_inline_kb(uid))
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith("act:"))
+def action_handler(call):
+    uid = call.from_user.id
+    _, action = call.data.split(":")
+    
+    if action == "search":
+        cmd_search(call.message)
+    elif action == "opp":
+        cmd_search_opp(call.message)
+    elif action == "premium":
+        bot.answer_callback_query(call.id, "Refer 3 friends to get premium!")
+    elif action == "settings":
+        cmd_settings(call.message)
+    elif action == "refer":
+        cmd_refer(call.message)
+    elif action == "stop":
+        cmd_stop(call.message)
+
+# Broadcast
+class Broadcaster:
+    """Sends one admin message to every user, in the background.
+
+    Users are streamed by user_id in chunks of BROADCAST_CHUNK and paced at
+    BROADCAST_RATE through the outbox at bulk priority. The cursor and
+    counters are saved after each chunk, so a restart resumes where it left
+    off (the unfinished chunk is sent again). A lease on the row keeps two
+    workers from running the same broadcast. A clean shutdown gives the
+    lease back. After a crash, resume() keeps trying until it lapses.
+    """
+
+    LEASE_SECONDS = 120
+
+    def __init__(self, rate=20, chunk=200):
+        self.rate = rate
+        self.chunk = chunk
+        self.cancelled = threading.Event()
+        self.stopping = threading.Event()
+        self._bid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, text):
+        with self._lock:
+            if self.running():
+                return None
+            with get_conn() as conn:
+                active = conn.execute("SELECT id FROM broadcasts WHERE status='running'").fetchone()
+                if active:
+                    return None
+                bid = conn.execute("INSERT INTO broadcasts (text, created_at, lease_until) VALUES (?, ?, ?)",
+                                   (text, datetime.utcnow().isoformat(), time.time() + self.LEASE_SECONDS)).lastrowid
+                conn.commit()
+            self._spawn(bid)
+            return bid
+
+    def resume(self):
+        """Pick up a broadcast a previous process left running. Returns its id, or None."""
+        with get_conn() as conn:
+            row = conn.execute("SELECT id FROM broadcasts WHERE status='running'").fetchone()
+        if not row:
+            return None
+        if not self._try_resume(row[0]):
+            # Another worker is sending it, or a crashed one still holds the lease
+            threading.Thread(target=self._await_lease, args=(row[0],), name="broadcast-resume", daemon=True).start()
+        return row[0]
+
+    def release(self):
+        """Stop sending and give the lease back, so the next process resumes right away."""
+        bid = self._bid
+        if bid is None or not self.running():
+            return
+        self.stopping.set()
+        with get_conn() as conn:
+            conn.execute("UPDATE broadcasts SET lease_until=NULL WHERE id=? AND status='running'", (bid,))
+            conn.commit()
+
+    def cancel(self):
+        with get_conn() as conn:
+            done = conn.execute("UPDATE broadcasts SET status='cancelled', finished_at=? WHERE status='running'",
+                                (datetime.utcnow().isoformat(),)).rowcount
+            conn.commit()
+        self.cancelled.set()
+        return done > 0
+
+    def status(self):
+        with get_conn() as conn:
+            return conn.execute("""
+                SELECT id, status, cursor, sent, failed, blocked, created_at, finished_at
+                FROM broadcasts ORDER BY id DESC LIMIT 1
+            """).fetchone()
+
+    def _try_resume(self, bid):
+        with get_conn() as conn:
+            if not self._claim(conn, bid):
+                return False
+        logger.info(f"Resuming broadcast #{bid}")
+        with self._lock:
+            self._spawn(bid)
+        return True
+
+    def _await_lease(self, bid):
+        while not self.stopping.is_set():
+            with get_conn() as conn:
+                row = conn.execute("SELECT status, lease_until FROM broadcasts WHERE id=?", (bid,)).fetchone()
+            if not row or row[0] != "running":
+                return
+            time.sleep(max(1.0, (row[1] or 0) - time.time() + 1))
+            if self._try_resume(bid):
+                return
+
+    def _claim(self, conn, bid):
+        now = time.time()
+        claimed = conn.execute("""
+            UPDATE broadcasts SET lease_until=? WHERE id=? AND status='running'
+            AND (lease_until IS NULL OR lease_until < ?)
+        """, (now + self.LEASE_SECONDS, bid, now)).rowcount
+        conn.commit()
+        return claimed == 1
+
+    def _spawn(self, bid):
+        self.cancelled.clear()
+        self._bid = bid
+        self._thread = threading.Thread(target=self._run, args=(bid,), name="broadcast", daemon=True)
+        self._thread.start()
+
+    def _run(self, bid):
         try:
-            bot.send_message(partner, text)
+            self._send_all(bid)
+        except Exception as e:
+            logger.error(f"Broadcast #{bid} stopped: {e}")
+            self._report(f"📣 Broadcast #{bid} stopped: {e}")
+
+    def _send_all(self, bid):
+        with get_conn() as conn:
+            text, cursor, sent, failed, blocked = conn.execute(
+                "SELECT text, cursor, sent, failed, blocked FROM broadcasts WHERE id=?", (bid,)).fetchone()
+        start, start_sent = time.monotonic(), sent
+        last_report = start
+        next_at = start
+        while not self.cancelled.is_set() and not self.stopping.is_set():
             with get_conn() as conn:
-                conn.execute("UPDATE users SET messages_sent=messages_sent+1 WHERE user_id=?", (uid,))
+                uids = [r[0] for r in conn.execute("""
+                    SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL
+                    ORDER BY user_id LIMIT ?
+                """, (cursor, self.chunk))]
+            if not uids:
+                break
+            futures = []
+            for uid in uids:
+                next_at = max(next_at + 1 / self.rate, time.monotonic())
+                time.sleep(max(0.0, next_at - time.monotonic()))
+                futures.append((uid, outbox.submit(_unqueued["send_message"], uid, text, priority=PRIORITY_BULK)))
+            gone = []
+            for uid, future in futures:
+                try:
+                    future.result()
+                    sent += 1
+                except apihelper.ApiTelegramException as e:
+                    if e.error_code == 403:
+                        gone.append(uid)
+                    else:
+                        failed += 1
+                except Exception:
+                    failed += 1
+            blocked += len(gone)
+            cursor = uids[-1]
+            with get_conn() as conn:
+                if gone:
+                    now = datetime.utcnow().isoformat()
+                    conn.executemany("UPDATE users SET blocked_at=? WHERE user_id=?", [(now, uid) for uid in gone])
+                still_running = conn.execute("""
+                    UPDATE broadcasts SET cursor=?, sent=?, failed=?, blocked=?, lease_until=?
+                    WHERE id=? AND status='running'
+                """, (cursor, sent, failed, blocked,
+                      None if self.stopping.is_set() else time.time() + self.LEASE_SECONDS, bid)).rowcount
                 conn.commit()
+            if not still_running:
+                self.cancelled.set()  # cancelled from another worker
+            if time.monotonic() - last_report > 60:
+                last_report = time.monotonic()
+                self._report(f"📣 Broadcast #{bid}: {sent} sent, {blocked} blocked, {failed} failed so far")
+
+        if self.stopping.is_set():
+            return  # shutting down; the next process resumes from the cursor
+        elapsed = time.monotonic() - start
+        rate = (sent - start_sent) / elapsed if elapsed else 0.0
+        if self.cancelled.is_set():
+            self._report(f"📣 Broadcast #{bid} cancelled: {sent} sent, {blocked} blocked, {failed} failed")
+            return
+        with get_conn() as conn:
+            conn.execute("UPDATE broadcasts SET status='done', finished_at=?, lease_until=NULL WHERE id=?",
+                         (datetime.utcnow().isoformat(), bid))
+            conn.commit()
+        self._report(f"📣 Broadcast #{bid} done in {elapsed:.0f}s ({rate:.1f} msg/s)\n"
+                     f"Sent: {sent}\nBlocked: {blocked}\nFailed: {failed}")
+
+    def _report(self, text):
+        try:
+            bot.send_message(ADMIN_ID, text)
         except:
-            bot.send_message(uid, "Couldn't send")
-    else:
-        bot.send_message(uid, "Not connected. Search someone", reply_markup=main_inline_kb(uid))
+            pass
+
+broadcaster = Broadcaster(BROADCAST_RATE, BROADCAST_CHUNK)
+
+def clear_blocked(uid):
+    # They wrote to the bot again, so broadcasts can reach them
+    with get_conn() as conn:
+        if conn.execute("UPDATE users SET blocked_at=NULL WHERE user_id=? AND blocked_at IS NOT NULL",
+                        (uid,)).rowcount:
+            conn.commit()
 
 # Admin
 @bot.message_handler(commands=['pradd'])
@@ -1429,6 +2729,106 @@ def cmd_unban(m):
     except:
         pass
 
+@bot.message_handler(commands=['reloadwords'])
+def cmd_reloadwords(m):
+    if m.from_user.id != ADMIN_ID:
+        bot.send_message(m.from_user.id, "Admin only")
+        return
+    if not os.path.exists(BANNED_WORDS_FILE):
+        bot.reply_to(m, f"No word list at {BANNED_WORDS_FILE} (one word per line)")
+        return
+    try:
+        count = moderation.load_file(BANNED_WORDS_FILE)
+    except Exception as e:
+        bot.reply_to(m, f"Reload failed, keeping old list: {e}")
+        return
+    bot.reply_to(m, f"Loaded {count} banned words")
+
+@bot.message_handler(commands=['bancheck'])
+def cmd_bancheck(m):
+    if m.from_user.id != ADMIN_ID:
+        bot.send_message(m.from_user.id, "Admin only")
+        return
+    missing, extra = ban_index.check()
+    if not missing and not extra:
+        bot.reply_to(m, f"Ban index OK ({ban_index.stats()['size']} active)")
+        return
+    ban_index.load()
+    bot.reply_to(m, f"Ban index was out of sync (missing {missing[:20]}, extra {extra[:20]}) - reloaded")
+
+@bot.message_handler(commands=['broadcast'])
+def cmd_broadcast(m):
+    if m.from_user.id != ADMIN_ID:
+        bot.send_message(m.from_user.id, "Admin only")
+        return
+    parts = m.text.split(None, 1)
+    arg = parts[1].strip() if len(parts) > 1 else ""
+    if not arg:
+        bot.reply_to(m, "Usage: /broadcast [message] | status | cancel")
+        return
+    if arg == "status":
+        row = broadcaster.status()
+        if not row:
+            bot.reply_to(m, "No broadcasts yet")
+            return
+        bid, status, cursor, sent, failed, blocked, created, finished = row
+        bot.reply_to(m, f"Broadcast #{bid}: {status}\nSent: {sent}\nBlocked: {blocked}\nFailed: {failed}\n"
+                        f"Last user: {cursor}\nStarted: {created[:19]}")
+        return
+    if arg == "cancel":
+        bot.reply_to(m, "Cancelled" if broadcaster.cancel() else "Nothing running")
+        return
+    bid = broadcaster.start(arg)
+    if bid is None:
+        bot.reply_to(m, "A broadcast is already running (/broadcast status)")
+        return
+    bot.reply_to(m, f"Broadcast #{bid} started at {BROADCAST_RATE:g} msg/s")
+
+def send_profile(summary):
+    if len(summary) > 4000:
+        summary = summary[:3950] + "\n..."
+    bot.send_message(ADMIN_ID, summary)
+
+@bot.message_handler(commands=['profile'])
+def cmd_profile(m):
+    if m.from_user.id != ADMIN_ID:
+        bot.send_message(m.from_user.id, "Admin only")
+        return
+    parts = m.text.split()[1:]
+    if parts == ["stop"]:
+        if profiler.stop() is None:
+            bot.reply_to(m, "Not profiling")
+        return
+    if parts == ["status"]:
+        st = profiler.status()
+        if not st:
+            bot.reply_to(m, "Not profiling")
+            return
+        limit = f"{st['updates']} updates" if st["updates"] else f"{st['seconds']:g}s"
+        bot.reply_to(m, f"Profiling ({st['mode']}): {st['calls']} updates in {st['elapsed']:.0f}s of {limit}")
+        return
+    mode = parts.pop(0) if parts and parts[0] in PROFILE_MODES else "sample"
+    updates, seconds = None, 60
+    if parts:
+        arg = parts[0].lower()
+        try:
+            if arg.endswith("s"):
+                seconds = float(arg[:-1])
+                valid = 0 < seconds < math.inf
+            else:
+                updates, seconds = int(arg), 3600  # an hour at most if traffic is thin
+                valid = updates > 0
+        except ValueError:
+            valid = False
+        if not valid or len(parts) > 1:
+            bot.reply_to(m, "Usage: /profile [cprofile|sample] [updates | seconds + 's'] | status | stop")
+            return
+    if not profiler.start(mode, updates=updates, seconds=seconds, on_done=send_profile):
+        bot.reply_to(m, "Already profiling (/profile status)")
+        return
+    limit = f"the next {updates} updates" if updates else f"{seconds:g}s"
+    bot.reply_to(m, f"Profiling ({mode}) for {limit}; the summary comes here, files go to {PROFILE_DIR}")
+
 @bot.message_handler(commands=['chatlog'])
 def cmd_chatlog(m):
     if m.from_user.id != ADMIN_ID:
@@ -1487,7 +2887,7 @@ def cmd_chatlog(m):
             partner = db_user(partner_id)
             partner_name = f"@{partner['username']}" if partner and partner['username'] else str(partner_id)
             log_text += f"  - With {partner_name} ({partner_id})\n"
-            log_text += f"    Time: {start[:10]}\n"
+            log_text += f"    Time: {start[:10]} • {len(decode_log(msgs))} messages\n"
         log_text += "\n"
     else:
         log_text += "No conversation history\n"
@@ -1498,42 +2898,316 @@ def cmd_chatlog(m):
     bot.send_message(ADMIN_ID, log_text)
 
 def set_cmds():
+    """Upload the command list, unless Telegram already has this exact one."""
+    cmds = [
+        types.BotCommand("start", "Setup profile"),
+        types.BotCommand("search", "Find partner"),
+        types.BotCommand("search_opposite_gender", "Find opposite gender"),
+        types.BotCommand("filter", "Premium - Search by country/age"),
+        types.BotCommand("reconnect", "Reconnect"),
+        types.BotCommand("next", "Next partner"),
+        types.BotCommand("stop", "Stop"),
+        types.BotCommand("refer", "Invite friends"),
+        types.BotCommand("settings", "Your profile"),
+        types.BotCommand("report", "Report"),
+        types.BotCommand("chatlog", "Admin - Chat log"),
+        types.BotCommand("broadcast", "Admin - Message everyone"),
+        types.BotCommand("profile", "Admin - Profile handlers"),
+    ]
+    digest = hashlib.sha256(json.dumps([c.to_dict() for c in cmds], sort_keys=True).encode()).hexdigest()
+    if meta_get("commands_hash") == digest:
+        return
     try:
-        cmds = [
-            types.BotCommand("start", "Setup profile"),
-            types.BotCommand("search", "Find partner"),
-            types.BotCommand("search_opposite_gender", "Find opposite gender"),
-            types.BotCommand("reconnect", "Reconnect"),
-            types.BotCommand("next", "Next partner"),
-            types.BotCommand("stop", "Stop"),
-            types.BotCommand("refer", "Invite friends"),
-            types.BotCommand("settings", "Your profile"),
-            types.BotCommand("report", "Report"),
-            types.BotCommand("chatlog", "Admin - Chat log"),
-        ]
         bot.set_my_commands(cmds)
+        meta_set("commands_hash", digest)
+        logger.info("Bot commands updated")
     except:
         pass
 
+# Every registered handler reports its latency and errors
+for _handlers in (bot.message_handlers, bot.callback_query_handlers):
+    for _h in _handlers:
+        _h["function"] = timed_handler(_h["function"])
+
+# Snapshot - live chats and queues survive a restart. The file is zlib-compressed JSON
+# behind a 4-byte header: restoring it only ever builds plain values, never runs code
+SNAPSHOT_MAGIC = b"GTS2"
+
+def save_snapshot():
+    queue = [(uid, gender, opposite, dict(extra, prefs=extra["prefs"].to_json()))
+             for uid, gender, opposite, extra in match_queue.export()]
+    state = {
+        "saved_at": time.time(),
+        "active_pairs": list(dict(active_pairs).items()),
+        "queue": queue,
+        "queue_clock": match_queue.clock(),
+        "pending_media": pending_media.export(),
+        "report_reason_pending": report_reason_pending.export(),
+        "pending_country": pending_country.export(),
+        "last_partner_disconnect": last_partner_disconnect.export(),
+        "chat_history": list(chat_history.export().items()),
+    }
+    blob = SNAPSHOT_MAGIC + zlib.compress(json.dumps(state, separators=(",", ":")).encode(), 1)
+    tmp = SNAPSHOT_PATH + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(blob)
+    os.replace(tmp, SNAPSHOT_PATH)
+    return len(blob)
+
+def restore_snapshot():
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f:
+            blob = f.read()
+    except FileNotFoundError:
+        return False
+    try:
+        if not blob.startswith(SNAPSHOT_MAGIC):
+            # GTS1 files were pickles; they are not loaded
+            raise ValueError("bad header")
+        state = json.loads(zlib.decompress(blob[len(SNAPSHOT_MAGIC):]))
+    except Exception as e:
+        logger.error(f"Ignoring unreadable snapshot: {e}")
+        return False
+    age = time.time() - state["saved_at"]
+    if age > SNAPSHOT_MAX_AGE_MINUTES * 60:
+        logger.info(f"Snapshot is {age / 60:.0f} min old, starting fresh")
+        return False
+    active_pairs.update(dict(state["active_pairs"]))
+    now = match_queue.clock()
+    for uid, gender, opposite, extra in state["queue"]:
+        if uid not in active_pairs:
+            extra["prefs"] = Prefs.from_json(extra["prefs"])
+            # since is on the old process's clock; keep how long they had waited, downtime included
+            extra["since"] = now - (state["queue_clock"] - extra["since"]) - age
+            match_queue.enqueue(uid, gender, opposite=opposite, **extra)
+    for name, ttlmap in (("pending_media", pending_media), ("report_reason_pending", report_reason_pending),
+                         ("pending_country", pending_country), ("last_partner_disconnect", last_partner_disconnect)):
+        for key, value, left in state[name]:
+            left = None if left is None else left - age
+            if left is None or left > 0:
+                ttlmap.set(key, value, ttl=left if left is not None else math.inf)
+    for uid, msgs in state["chat_history"]:
+        for cid, mid in msgs:
+            chat_history.save(uid, cid, mid)
+    logger.info(f"Restored snapshot from {age:.1f}s ago: {len(active_pairs) // 2} chats, {len(match_queue)} waiting")
+    return True
+
+def snapshot_loop():
+    while True:
+        time.sleep(SNAPSHOT_SECONDS)
+        try:
+            save_snapshot()
+        except Exception as e:
+            logger.error(f"Snapshot failed: {e}")
+
+_snapshots = threading.Event()
+
+def start_snapshots():
+    if sessions.shared:
+        # The session database already outlives restarts, and every worker would race on one file
+        match_scheduler.notify()
+        return
+    restore_snapshot()
+    match_scheduler.notify()
+    threading.Thread(target=snapshot_loop, name="snapshot", daemon=True).start()
+    _snapshots.set()
+
+# Shutdown - one hook, so the order is explicit: later steps depend on earlier ones
+def shutdown():
+    steps = [
+        update_workers.shutdown,  # finish the updates already handed to workers
+        broadcaster.release,
+        albums.flush_all,         # relays the albums still being collected
+        outbox.close,             # drains sends; their callbacks count stats
+        stat_buffer.flush,        # after the drain, so those counts are written
+    ]
+    if _snapshots.is_set():
+        steps.append(save_snapshot)
+    steps.append(db_pool.close_all)
+    for step in steps:
+        try:
+            step()
+        except Exception:
+            logger.exception(f"Shutdown step {step.__qualname__} failed")
+
+atexit.register(shutdown)
+
+def _on_sigterm(signum, frame):
+    # Raising SystemExit runs shutdown(): flush albums, drain sends, flush counters, snapshot, close the pool
+    raise SystemExit(0)
+
+# Asyncio runtime - BOT_RUNTIME=asyncio
+# Plain relays are the bulk of traffic: their DB checks run on a small executor and
+# the send is handed to the outbox, so no thread waits on Telegram while it goes out.
+# Every other update runs the regular handlers on a separate executor.
+BUTTON_TEXTS = {"👤 Info", "➡️ Next", "❌ Stop", "🔍 Find Someone", "💕 Find Opposite Gender",
+                "💎 Opposite Gender (Premium)", "⚙️ Settings", "👥 Refer"}
+MEDIA_FIELDS = ("photo", "document", "video", "animation", "sticker", "audio", "voice")
+
+def relay_partner(m):
+    """Partner a message can go straight to, or None when the full handlers must see it."""
+    uid = m.from_user.id
+    if m.chat.id in bot.next_step_backend.handlers or uid in report_reason_pending:
+        return None
+    if m.content_type == "text":
+        text = (m.text or "").strip()
+        if text.startswith("/") or text in BUTTON_TEXTS:
+            return None
+    elif m.content_type not in MEDIA_FIELDS or m.media_group_id:
+        return None
+    if is_banned(uid):
+        return None
+    if m.content_type == "text":
+        db_new_user(m.from_user)
+    u = db_user(uid)
+    if not u or not u["gender"] or not u["age"]:
+        return None
+    if m.content_type == "text":
+        if (uid in pending_country and not u.get("country")) or has_bad_content(text):
+            return None
+    elif not u["media_approved"]:
+        return None  # media still needs the consent prompt
+    return active_pairs.get(uid)
+
+async def relay_async(m, loop, db_executor):
+    partner = await loop.run_in_executor(db_executor, relay_partner, m)
+    if partner is None:
+        return False
+    uid = m.from_user.id
+    start = time.perf_counter()
+    save_msg(uid, m.chat.id, m.message_id)
+    if m.content_type == "text":
+        save_msg(partner, m.chat.id, m.message_id)
+        send, payload, stat = _unqueued["send_message"], m.text.strip(), "messages_sent"
+    else:
+        media = getattr(m, m.content_type)
+        file_id = (media[-1] if m.content_type == "photo" else media).file_id
+        send, payload, stat = _unqueued["send_" + m.content_type], file_id, "media_approved"
+    # Queued, not awaited: the outbox keeps the chat's order, so its next update needn't wait on Telegram
+    relay(uid, partner, send, payload, stat)
+    HANDLER_LATENCY.observe(time.perf_counter() - start, "relay_async")
+    HANDLER_CALLS.inc("relay_async", "ok")
+    return True
+
+def update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return None
+
+def run_asyncio():
+    from telebot.async_telebot import AsyncTeleBot  # imports aiohttp
+
+    db_executor = ThreadPoolExecutor(ASYNC_DB_WORKERS, thread_name_prefix="async-db")
+    sync_executor = ThreadPoolExecutor(ASYNC_SYNC_WORKERS, thread_name_prefix="async-sync")
+
+    class RelayBot(AsyncTeleBot):
+        # Updates run concurrently across chats but one at a time, in order, within a chat.
+        # They pass through one FIFO queue to a fixed pool of consumers, so they are
+        # taken in arrival order, and a full queue holds up the next getUpdates
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.queue = asyncio.Queue(ASYNC_MAX_UPDATES)
+            self.batch_queued = asyncio.Event()
+            self.batch_queued.set()
+            self.chats = {}  # chat id -> [lock, updates holding or waiting for it]
+            self.consumers = [asyncio.create_task(self.consume()) for _ in range(ASYNC_MAX_UPDATES)]
+
+        async def get_updates(self, *args, **kwargs):
+            # Polling runs process_new_updates as a task without awaiting it, so the next
+            # batch is only fetched once the last one is all in the queue
+            await self.batch_queued.wait()
+            updates = await super().get_updates(*args, **kwargs)
+            if updates:
+                self.batch_queued.clear()
+            return updates
+
+        async def process_new_updates(self, updates):
+            try:
+                for update in updates:
+                    await self.queue.put(update)
+            finally:
+                self.batch_queued.set()
+
+        async def consume(self):
+            loop = asyncio.get_running_loop()
+            while True:
+                update = await self.queue.get()
+                chat_id = update_chat_id(update)
+                entry = self.chats.setdefault(chat_id, [asyncio.Lock(), 0])
+                entry[1] += 1
+                try:
+                    # Updates leave the queue in arrival order and asyncio.Lock is FIFO, so a chat's updates keep their order
+                    async with entry[0]:
+                        if update.message and await relay_async(update.message, loop, db_executor):
+                            continue
+                        await loop.run_in_executor(sync_executor, bot.process_new_updates, [update])
+                except Exception as e:
+                    logger.error(f"Update {update.update_id} failed: {e}")
+                finally:
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self.chats[chat_id]
+
+    async def main():
+        abot = RelayBot(API_TOKEN)
+        await abot.remove_webhook()
+        await abot.infinity_polling(timeout=60, request_timeout=90)
+
+    logger.info("Bot running (asyncio)...")
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        logger.error(f"Polling error: {e}")
+
 # Run
 def poll():
     logger.info("Bot running...")
     try:
+        bot.remove_webhook()
         bot.infinity_polling(timeout=60, long_polling_timeout=60)
     except Exception as e:
         logger.error(f"Polling error: {e}")
 
+def start_webhook():
+    if not WEBHOOK_URL:
+        logger.error("BOT_MODE=webhook needs WEBHOOK_URL (public base URL of this app)")
+        return
+    try:
+        bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                        max_connections=WEBHOOK_WORKERS)
+        logger.info(f"Webhook set: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    except Exception as e:
+        logger.error(f"Webhook setup error: {e}")
+
 def flask():
     PORT = int(os.getenv("PORT", 10000))
     logger.info(f"Flask on 0.0.0.0:{PORT}")
     app.run(host="0.0.0.0", port=PORT, debug=False, use_reloader=False)
 
+# gunicorn imports bot:app without running __main__, so webhook mode starts here
+if BOT_MODE == "webhook" and __name__ != "__main__":
+    init_db()
+    set_cmds()
+    bot_info()
+    start_snapshots()
+    broadcaster.resume()
+    start_webhook()
+
 if __name__ == "__main__":
     init_db()
     set_cmds()
+    bot_info()
+    start_snapshots()
+    broadcaster.resume()
+    signal.signal(signal.SIGTERM, _on_sigterm)
     logger.info("GhostTalk v4.1 - Ready (Report Forwarding + Reconnect + Admin Invisible)")
     
-    t = threading.Thread(target=poll, daemon=True)
-    t.start()
+    if BOT_MODE == "webhook":
+        start_webhook()
+    else:
+        t = threading.Thread(target=run_asyncio if BOT_RUNTIME == "asyncio" else poll, daemon=True)
+        t.start()
     
     flask()
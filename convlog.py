@@ -0,0 +1,111 @@
+"""
+Compact encoding for chat_conversations.messages_log.
+
+A log is the (chat_id, message_id) list from ChatHistory. Encoded form:
+
+    byte 0   format version (1)
+    byte 1   flags; bit 0 set means the rest is zlib-compressed
+    rest     varint count, then per entry the zigzag varint deltas of
+             chat_id and message_id from the previous entry
+
+Chat ids repeat and message ids climb slowly, so most entries take two
+bytes. zlib is only kept when it makes the payload smaller. decode() also
+reads the repr strings older versions wrote, so rows can be converted
+lazily or all at once.
+"""
+
+import ast
+import zlib
+
+VERSION = 1
+FLAG_ZLIB = 1
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _put_varint(out, n):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varint(buf, pos):
+    shift = result = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def encode(messages, compress=True):
+    body = bytearray()
+    _put_varint(body, len(messages))
+    prev_cid = prev_mid = 0
+    for cid, mid in messages:
+        _put_varint(body, _zigzag(cid - prev_cid))
+        _put_varint(body, _zigzag(mid - prev_mid))
+        prev_cid, prev_mid = cid, mid
+    flags = 0
+    if compress and len(body) > 64:
+        packed = zlib.compress(bytes(body), 6)
+        if len(packed) < len(body):
+            body, flags = packed, FLAG_ZLIB
+    return bytes((VERSION, flags)) + bytes(body)
+
+
+def decode(blob):
+    """List of (chat_id, message_id) from any stored form; [] if empty or unreadable."""
+    if not blob:
+        return []
+    if isinstance(blob, str):
+        return _decode_legacy(blob)
+    try:
+        return _decode_v1(blob)
+    except (ValueError, IndexError, zlib.error):
+        # A newer version, or a blob cut short
+        return []
+
+
+def _decode_v1(blob):
+    if blob[0] != VERSION:
+        raise ValueError(f"unknown conversation log version {blob[0]}")
+    body = blob[2:]
+    if blob[1] & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    count, pos = _get_varint(body, 0)
+    messages = []
+    cid = mid = 0
+    for _ in range(count):
+        delta, pos = _get_varint(body, pos)
+        cid += _unzigzag(delta)
+        delta, pos = _get_varint(body, pos)
+        mid += _unzigzag(delta)
+        messages.append((cid, mid))
+    return messages
+
+
+def _decode_legacy(text):
+    try:
+        return parse_legacy(text)
+    except ValueError:
+        return []
+
+
+def parse_legacy(text):
+    """The str() of a (chat_id, message_id) list that disc_user() used to write; ValueError if it isn't one."""
+    if not text.strip():
+        return []
+    try:
+        return [(int(cid), int(mid)) for cid, mid in ast.literal_eval(text)]
+    except (ValueError, SyntaxError, TypeError) as e:
+        raise ValueError(f"unreadable legacy conversation log: {e}") from None
@@ -0,0 +1,127 @@
+"""
+Recent message history per user, kept for reports and chat logs.
+
+Each user gets a fixed-size ring of (chat_id, message_id) pairs stored in
+two int64 arrays, so saving a message never shifts a list and a full ring
+costs 16 bytes per slot. Users are kept in LRU order; once the store goes
+over its byte ceiling, or a user has been idle too long, the least
+recently used users are dropped - except those `is_active` says are still
+chatting. If a pass over everyone can't get back under the ceiling, the
+next len/8 saves skip eviction: the store may overshoot by that many users,
+and a save costs amortised O(1) instead of a scan of everyone.
+"""
+
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+
+class _Ring:
+    __slots__ = ("chats", "mids", "start", "size", "touched")
+
+    def __init__(self, capacity):
+        self.chats = array("q", bytes(8 * capacity))
+        self.mids = array("q", bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+        self.touched = time.monotonic()
+
+    def append(self, cid, mid):
+        capacity = len(self.mids)
+        pos = (self.start + self.size) % capacity
+        self.chats[pos] = cid
+        self.mids[pos] = mid
+        if self.size < capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % capacity
+        self.touched = time.monotonic()
+
+    def items(self):
+        capacity = len(self.mids)
+        return [(self.chats[(self.start + i) % capacity], self.mids[(self.start + i) % capacity])
+                for i in range(self.size)]
+
+    def nbytes(self):
+        return sys.getsizeof(self.chats) + sys.getsizeof(self.mids) + sys.getsizeof(self)
+
+
+class ChatHistory:
+    def __init__(self, per_user=50, max_bytes=64 * 1024 * 1024, idle_seconds=6 * 3600, is_active=None):
+        self.per_user = per_user
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.is_active = is_active or (lambda uid: False)
+        self.evicted = 0
+        self._skip = 0  # saves left before _evict() tries again after a fruitless pass
+        self._rings = OrderedDict()
+        self._bytes = 0
+        self._entries = 0
+        self._lock = threading.Lock()
+
+    def save(self, uid, cid, mid):
+        with self._lock:
+            ring = self._rings.get(uid)
+            if ring is None:
+                ring = self._rings[uid] = _Ring(self.per_user)
+                self._bytes += ring.nbytes()
+            else:
+                self._rings.move_to_end(uid)
+            before = ring.size
+            ring.append(cid, mid)
+            self._entries += ring.size - before
+            self._evict()
+
+    def get(self, uid):
+        """Oldest-first list of (chat_id, message_id); empty if nothing is kept."""
+        with self._lock:
+            ring = self._rings.get(uid)
+            return ring.items() if ring else []
+
+    def pop(self, uid):
+        with self._lock:
+            ring = self._rings.pop(uid, None)
+            if ring is None:
+                return []
+            self._forget(ring)
+            return ring.items()
+
+    def __contains__(self, uid):
+        return uid in self._rings
+
+    def __len__(self):
+        return len(self._rings)
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._rings), "entries": self._entries,
+                    "bytes": self._bytes, "evicted": self.evicted}
+
+    def export(self):
+        with self._lock:
+            return {uid: ring.items() for uid, ring in self._rings.items()}
+
+    def _forget(self, ring):
+        self._bytes -= ring.nbytes()
+        self._entries -= ring.size
+
+    def _evict(self):
+        # Oldest users first; active ones are skipped by moving them to the back
+        if self._skip:
+            self._skip -= 1
+            return
+        cutoff = time.monotonic() - self.idle_seconds
+        for _ in range(len(self._rings)):
+            uid, ring = next(iter(self._rings.items()))
+            if self._bytes <= self.max_bytes and ring.touched >= cutoff:
+                return
+            if self.is_active(uid):
+                self._rings.move_to_end(uid)
+                continue
+            del self._rings[uid]
+            self._forget(ring)
+            self.evicted += 1
+        # Went round everyone and still over
+        self._skip = len(self._rings) // 8
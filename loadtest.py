@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+"""
+GhostTalk load tests against a fake Bot API.
+
+Starts a local HTTP server that speaks enough of the Bot API for the bot
+(getUpdates, send*/copyMessage/forwardMessage, getMe, ...), answers every
+send after a fixed delay like a slow Telegram would, and runs the bot in a
+child process with telebot's apihelper pointed at it. Runs offline.
+
+Two suites:
+    burst     relay messages between already paired users, all at once;
+              measures raw relay throughput
+    scenario  N simulated users onboard with /start, /search, chat, /next,
+              sometimes /report, then /stop; measures match and relay
+              latency, updates/s and the bot's DB and API call counts
+
+    python loadtest.py                                  # both suites, both runtimes
+    python loadtest.py --suite scenario --users 400 --runtime asyncio
+    python loadtest.py --suite scenario --max-relay-p95-ms 500   # exit 1 if slower
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+TOKEN = "123456:loadtest"
+FIRST_UID = 100000
+SEND_METHODS = ("sendMessage", "sendPhoto", "sendDocument", "sendVideo", "sendAnimation", "sendSticker",
+                "sendAudio", "sendVoice", "sendMediaGroup", "copyMessage", "forwardMessage", "editMessageText")
+
+
+class FakeBotAPI:
+    """Bot API stand-in: hands out queued updates and records every send the bot makes."""
+
+    def __init__(self, api_delay=0.05):
+        self.api_delay = api_delay
+        self.updates = []
+        self.calls = []
+        self.by_chat = defaultdict(list)  # chat_id -> [(time, text)]
+        self.by_text = {}  # text -> first delivery time
+        self.pushed = 0
+        self.polled = threading.Event()
+        self._cond = threading.Condition()
+        self._message_id = 0
+        self._update_id = 0
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if body and "application/json" in (self.headers.get("Content-Type") or ""):
+                    params.update(json.loads(body))
+                elif body:
+                    params.update(parse_qsl(body.decode()))
+                method = url.path.rsplit("/", 1)[-1]
+                payload = json.dumps({"ok": True, "result": api.handle(method, params)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.server.handle_error = lambda request, address: None  # the bot is killed mid-request
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def next_id(self):
+        with self._cond:
+            self._update_id += 1
+            return self._update_id
+
+    def push(self, updates):
+        with self._cond:
+            self.updates.extend(updates)
+            self.pushed += len(updates)
+            self._cond.notify_all()
+
+    def handle(self, method, params):
+        if method == "getUpdates":
+            return self.get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "GhostTalk", "username": "ghosttalk_load_bot"}
+        if method not in SEND_METHODS:
+            return True
+        time.sleep(self.api_delay)
+        chat_id = int(params.get("chat_id", 0))
+        text = params.get("text", "")
+        with self._cond:
+            self._message_id += 1
+            message_id = self._message_id
+            now = time.monotonic()
+            self.calls.append((now, method, params))
+            self.by_chat[chat_id].append((now, text))
+            self.by_text.setdefault(text, now)
+            self._cond.notify_all()
+        if method == "copyMessage":
+            return {"message_id": message_id}
+        message = {"message_id": message_id, "date": int(time.time()), "text": text,
+                   "chat": {"id": chat_id, "type": "private"}}
+        return [message] if method == "sendMediaGroup" else message
+
+    def get_updates(self, offset, timeout):
+        self.polled.set()
+        deadline = time.monotonic() + min(timeout, 1.0)
+        with self._cond:
+            while True:
+                ready = [u for u in self.updates if u["update_id"] >= offset]
+                if ready or time.monotonic() >= deadline:
+                    # Updates below offset were confirmed by the bot
+                    self.updates = ready
+                    return ready[:100]
+                self._cond.wait(deadline - time.monotonic())
+
+    def wait_for(self, predicate, count, timeout):
+        """Wait until `count` recorded calls satisfy `predicate`; returns them."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                hits = [c for c in self.calls if predicate(c)]
+                if len(hits) >= count or time.monotonic() >= deadline:
+                    return hits
+                self._cond.wait(max(0.0, deadline - time.monotonic()))
+
+    def wait_message(self, chat_id, needle, start, timeout):
+        """First message to chat_id at index >= start containing needle: (next index, time) or (start, None)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                msgs = self.by_chat[chat_id]
+                for i in range(start, len(msgs)):
+                    if needle in msgs[i][1]:
+                        return i + 1, msgs[i][0]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return start, None
+                self._cond.wait(remaining)
+
+    def has_message(self, chat_id, needle, start):
+        with self._cond:
+            return any(needle in text for _, text in self.by_chat[chat_id][start:])
+
+
+def user_json(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"User {uid}", "username": f"user{uid}"}
+
+
+def text_update(update_id, uid, text):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": uid, "type": "private"}, "from": user_json(uid),
+    }}
+
+
+def callback_update(update_id, uid, data):
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user_json(uid), "chat_instance": str(uid), "data": data,
+        "message": {"message_id": update_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"}},
+    }}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# Child: the bot itself, optionally seeded with paired users
+def run_child(runtime, port, pairs, metrics_port=None):
+    import bot
+    from telebot import apihelper, types
+
+    api_url = f"http://127.0.0.1:{port}/bot{{0}}/{{1}}"
+    apihelper.API_URL = api_url
+    if runtime == "asyncio":
+        from telebot import asyncio_helper
+        asyncio_helper.API_URL = api_url
+
+    bot.init_db()
+    for i in range(pairs):
+        a, b = FIRST_UID + 2 * i, FIRST_UID + 2 * i + 1
+        for uid, gender in ((a, "Male"), (b, "Female")):
+            bot.db_new_user(types.User(uid, False, f"User {uid}", username=f"user{uid}"))
+            bot.db_set_gender(uid, gender)
+            bot.db_set_age(uid, 25)
+            bot.db_set_country(uid, "India", "🇮🇳")
+        bot.sessions.pair(a, b)
+    if metrics_port:
+        threading.Thread(target=bot.app.run, daemon=True,
+                         kwargs={"host": "127.0.0.1", "port": metrics_port, "use_reloader": False}).start()
+    if runtime == "asyncio":
+        bot.run_asyncio()
+    else:
+        bot.poll()
+
+
+def start_child(runtime, api, pairs=0, metrics_port=None, env=None):
+    env = dict(os.environ, **(env or {}))
+    env.update({
+        "DATA_PATH": tempfile.mkdtemp(prefix="ghosttalk-load-"),
+        "BOT_TOKEN": TOKEN,
+        "ADMIN_ID": "1",
+        "BOT_RUNTIME": runtime,
+        # The fake API has no bot-wide limit; per-chat pacing stays as deployed unless --chat-rate lifts it
+        "SEND_RATE_GLOBAL": "100000",
+        "SEND_WORKERS": "64",
+    })
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", runtime, "--port", str(api.port),
+           "--pairs", str(pairs)]
+    if metrics_port:
+        cmd += ["--metrics-port", str(metrics_port)]
+    return subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def scrape(metrics_port):
+    """The child's /metrics as {name: {label string: value}}."""
+    text = urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=10).read().decode()
+    out = defaultdict(dict)
+    for line in text.splitlines():
+        m = re.match(r"^(\w+)(\{[^}]*\})? (\S+)$", line)
+        if m:
+            out[m.group(1)][m.group(2) or ""] = float(m.group(3))
+    return out
+
+
+# Burst suite
+def relay_burst(runtime, updates, pairs, api_delay, timeout=120):
+    api = FakeBotAPI(api_delay).start()
+    child = start_child(runtime, api, pairs)
+    try:
+        if not api.polled.wait(60):
+            raise RuntimeError(f"{runtime} bot never polled")
+        sent = {}
+        batch = []
+        for k in range(updates):
+            i = k % pairs
+            uid = FIRST_UID + 2 * i + (k // pairs) % 2
+            text = f"load-{k}"
+            batch.append(text_update(api.next_id(), uid, text))
+            sent[text] = time.monotonic()
+        start = time.monotonic()
+        api.push(batch)
+        hits = api.wait_for(lambda c: c[1] == "sendMessage" and c[2].get("text", "").startswith("load-"),
+                            updates, timeout)
+        elapsed = max(c[0] for c in hits) - start if hits else timeout
+        latency = [t - sent[p["text"]] for t, _, p in hits]
+    finally:
+        child.kill()
+        child.wait()
+        api.stop()
+    return {"delivered": len(hits), "elapsed": elapsed, "throughput": len(hits) / elapsed,
+            "p50": percentile(latency, 0.5), "p95": percentile(latency, 0.95), "p99": percentile(latency, 0.99)}
+
+
+# Scenario suite
+class SimUser:
+    """One scripted user, reacting to what the bot sends them."""
+
+    def __init__(self, api, uid, stats, rng, think, timeout=15):
+        self.api = api
+        self.uid = uid
+        self.stats = stats
+        self.rng = rng
+        self.think = think
+        self.timeout = timeout
+        self.cursor = 0
+
+    def send(self, text=None, callback=None):
+        update_id = self.api.next_id()
+        if callback:
+            self.api.push([callback_update(update_id, self.uid, callback)])
+        else:
+            self.api.push([text_update(update_id, self.uid, text)])
+        return time.monotonic()
+
+    def expect(self, needle, timeout=None):
+        self.cursor, at = self.api.wait_message(self.uid, needle, self.cursor, timeout or self.timeout)
+        return at
+
+    def pause(self):
+        time.sleep(self.rng.uniform(0, 2 * self.think))
+
+    def step(self, needle, text=None, callback=None):
+        start = self.send(text, callback)
+        at = self.expect(needle)
+        if at is None:
+            raise TimeoutError(f"user {self.uid} never got '{needle}'")
+        self.stats.add("onboarding", at - start)
+
+    def run(self, rounds, messages, report_rate):
+        try:
+            self.step("gender", "/start")
+            self.step("How old", callback=self.rng.choice(("sex:male", "sex:female")))
+            self.step("where you from", "25")
+            self.step("Profile done", "India")
+            searched = self.send("/search")
+            for r in range(rounds):
+                found = self.expect("Found someone")
+                if found is None:
+                    self.stats.count("unmatched")
+                    break
+                self.stats.add("match", found - searched)
+                ended = False
+                for j in range(messages):
+                    self.pause()
+                    if self.api.has_message(self.uid, "Chat ended.", self.cursor):
+                        ended = True
+                        break
+                    text = f"sim-{self.uid}-{r}-{j}"
+                    self.stats.relay_sent[text] = self.send(text)
+                if r == rounds - 1:
+                    break
+                if not ended and self.rng.random() < report_rate:
+                    self.send("/report")
+                    self.stats.count("reports")
+                searched = self.send("/search" if ended else "/next")
+            self.send("/stop")
+        except TimeoutError:
+            self.stats.count("stuck")
+
+
+class ScenarioStats:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.relay_sent = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+
+def scenario(runtime, users, rounds, messages, api_delay, think=0.05, report_rate=0.1, seed=1):
+    api = FakeBotAPI(api_delay).start()
+    metrics_port = free_port()
+    child = start_child(runtime, api, metrics_port=metrics_port)
+    stats = ScenarioStats()
+    try:
+        if not api.polled.wait(60):
+            raise RuntimeError(f"{runtime} bot never polled")
+        rng = random.Random(seed)
+        sims = [SimUser(api, FIRST_UID + i, stats, random.Random(rng.random()), think) for i in range(users)]
+        threads = [threading.Thread(target=s.run, args=(rounds, messages, report_rate), daemon=True) for s in sims]
+        start = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - start
+        time.sleep(1)  # let relays still in the outbox land
+        metrics = scrape(metrics_port)
+    finally:
+        child.kill()
+        child.wait()
+        api.stop()
+
+    relay = [api.by_text[text] - sent for text, sent in stats.relay_sent.items() if text in api.by_text]
+    db = metrics.get("ghosttalk_db_seconds_count", {})
+    ops = defaultdict(int)
+    for labels, value in db.items():
+        ops[labels.split('"')[1] if '"' in labels else "?"] += int(value)
+    handled = sum(v for k, v in metrics.get("ghosttalk_handler_calls_total", {}).items())
+    return {
+        "elapsed": elapsed, "updates": api.pushed, "updates_per_sec": api.pushed / elapsed,
+        "handled": int(handled),
+        "onboarding": stats.samples["onboarding"], "match": stats.samples["match"], "relay": relay,
+        "relay_sent": len(stats.relay_sent), "counters": dict(stats.counters),
+        "db_ops": dict(ops), "db_writes": ops["INSERT"] + ops["UPDATE"] + ops["DELETE"] + ops["REPLACE"],
+        "api_calls": int(sum(metrics.get("ghosttalk_api_calls_total", {}).values())),
+    }
+
+
+def ms(seconds):
+    return f"{seconds * 1000:7.0f} ms"
+
+
+def pcts(values):
+    return f"p50 {ms(percentile(values, 0.5))}  p95 {ms(percentile(values, 0.95))}  p99 {ms(percentile(values, 0.99))}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--suite", choices=("burst", "scenario"), action="append")
+    parser.add_argument("--runtime", choices=("threaded", "asyncio"), action="append")
+    parser.add_argument("--api-delay", type=float, default=0.05, help="seconds the fake API takes per send")
+    parser.add_argument("--updates", type=int, default=2000, help="burst: relay messages")
+    parser.add_argument("--pairs", type=int, default=200, help="burst: chats the messages spread over")
+    parser.add_argument("--users", type=int, default=100, help="scenario: simulated users")
+    parser.add_argument("--rounds", type=int, default=3, help="scenario: chats per user")
+    parser.add_argument("--messages", type=int, default=10, help="scenario: messages per chat")
+    parser.add_argument("--think-ms", type=float, default=50, help="scenario: mean pause between messages")
+    parser.add_argument("--chat-rate", type=float, help="per-chat sends/s the bot paces to (default: the bot's 1/s)")
+    parser.add_argument("--max-relay-p95-ms", type=float)
+    parser.add_argument("--max-match-p95-ms", type=float)
+    parser.add_argument("--min-updates-per-sec", type=float, help="burst: minimum relay throughput")
+    parser.add_argument("--child")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--metrics-port", type=int)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args.child, args.port, args.pairs, args.metrics_port)
+
+    if args.chat_rate:
+        os.environ.update(SEND_RATE_CHAT=str(args.chat_rate), SEND_BURST_CHAT=str(max(3, int(args.chat_rate))))
+    failures = []
+
+    def gate(limit, value, label):
+        if limit is not None and value > limit:
+            failures.append(f"{label} {value:.1f} > {limit:g}")
+
+    for suite in args.suite or ["burst", "scenario"]:
+        for runtime in args.runtime or ["threaded", "asyncio"]:
+            if suite == "burst":
+                r = relay_burst(runtime, args.updates, args.pairs, args.api_delay)
+                print(f"[burst/{runtime}] {r['delivered']}/{args.updates} relays across {args.pairs} chats, "
+                      f"API delay {args.api_delay * 1000:.0f} ms")
+                print(f"  throughput {r['throughput']:8.1f} msg/s")
+                print(f"  relay      p50 {ms(r['p50'])}  p95 {ms(r['p95'])}  p99 {ms(r['p99'])}")
+                gate(args.max_relay_p95_ms, r["p95"] * 1000, f"burst/{runtime} relay p95 ms")
+                if args.min_updates_per_sec is not None and r["throughput"] < args.min_updates_per_sec:
+                    failures.append(f"burst/{runtime} throughput {r['throughput']:.1f} < {args.min_updates_per_sec:g}")
+                continue
+            r = scenario(runtime, args.users, args.rounds, args.messages, args.api_delay, args.think_ms / 1000)
+            c = r["counters"]
+            print(f"[scenario/{runtime}] {args.users} users x {args.rounds} chats x {args.messages} messages, "
+                  f"API delay {args.api_delay * 1000:.0f} ms")
+            print(f"  {r['updates']} updates in {r['elapsed']:.1f}s ({r['updates_per_sec']:.1f}/s), "
+                  f"{r['handled']} handler runs, {r['api_calls']} API calls")
+            print(f"  onboarding {pcts(r['onboarding'])}")
+            print(f"  match      {pcts(r['match'])}  ({len(r['match'])} matches, "
+                  f"{c.get('unmatched', 0)} unmatched, {c.get('stuck', 0)} stuck)")
+            print(f"  relay      {pcts(r['relay'])}  ({len(r['relay'])}/{r['relay_sent']} delivered, "
+                  f"{c.get('reports', 0)} reports)")
+            print(f"  DB         {r['db_writes']} writes, {r['db_ops'].get('COMMIT', 0)} commits, "
+                  f"{r['db_ops'].get('SELECT', 0)} selects")
+            gate(args.max_relay_p95_ms, percentile(r["relay"], 0.95) * 1000, f"scenario/{runtime} relay p95 ms")
+            gate(args.max_match_p95_ms, percentile(r["match"], 0.95) * 1000, f"scenario/{runtime} match p95 ms")
+
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,495 @@
+"""
+GhostTalk matchmaking queues.
+
+Each waiting user has a gender, country and age, read once when they join.
+Searchers may also have preferences (Prefs): a wanted gender, country and
+age range. A match needs both sides to accept each other. Random searchers
+have no preferences and accept anyone.
+
+Waiters sit in FIFO buckets keyed by two things:
+
+    accepts what the waiter accepts: the wanted gender and country (or
+            "any"), and one key per age in their range (or "any"). Waiters
+            without preferences have the single key any/any/any. The
+            waiters who accept a searcher are under at most eight of these:
+            their gender or any, times their country or any, times their age
+            or any.
+    is      who the waiter is, under four keys: gender; gender + country;
+            gender + age; gender + country + age. A searcher reads only the
+            key that matches the fields their preferences set, so that is one
+            key per acceptable gender, times one per age in range when they
+            filter on age.
+
+A lookup reads the head of each bucket under both: no waiter is checked
+against the searcher's preferences one by one. Buckets are heaps on arrival
+order with lazy deletion, so a lookup is O(keys) bucket heads and joining or
+leaving is O(keys * log n).
+
+Preferences other than gender widen while a searcher waits. After each
+`widen_after` seconds one of them is relaxed: first the age range grows by
+WIDEN_AGE years a side, then the country is dropped, then the age range. A
+step that wouldn't change anything (no country set, ages already 12-99) is
+skipped, so each one gives the searcher more partners.
+
+match() only tries users who joined or widened since its last run. Nobody else
+had a compatible partner then, and people leaving the queue can't change that.
+MatchScheduler runs match() on one thread, every tick and whenever a
+handler signals a new searcher.
+
+Hidden users (the admin) are never indexed, so nobody gets paired with them by
+chance. A hidden searcher with preferences still looks for partners on every
+pass; one without is parked and never matched.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+
+GENDERS = ("Male", "Female", None)
+OPPOSITE = {"Male": "Female", "Female": "Male"}
+MIN_AGE, MAX_AGE = 12, 99
+WIDEN_AGE = 5
+WIDEN_STEPS = 3  # at most: age range wider, then country dropped, then age range dropped
+ANY = "*"
+OPEN = (ANY, ANY, ANY)  # what a waiter without preferences accepts
+
+logger = logging.getLogger(__name__)
+
+
+class Prefs:
+    """What a searcher wants from a partner; None means any."""
+
+    __slots__ = ("gender", "country", "ages")
+
+    def __init__(self, gender=None, country=None, ages=None):
+        self.gender = gender
+        self.country = country
+        self.ages = tuple(ages) if ages else None
+
+    def __bool__(self):
+        return self.gender is not None or self.country is not None or self.ages is not None
+
+    def __eq__(self, other):
+        return isinstance(other, Prefs) and (self.gender, self.country, self.ages) == (other.gender, other.country, other.ages)
+
+    def __repr__(self):
+        return f"Prefs(gender={self.gender!r}, country={self.country!r}, ages={self.ages!r})"
+
+    def __getstate__(self):
+        return (self.gender, self.country, self.ages)
+
+    def __setstate__(self, state):
+        self.gender, self.country, self.ages = state
+
+    def accepts(self, waiter):
+        if self.gender is not None and waiter.gender != self.gender:
+            return False
+        if self.country is not None and waiter.country != self.country:
+            return False
+        if self.ages is not None and (waiter.age is None or not self.ages[0] <= waiter.age <= self.ages[1]):
+            return False
+        return True
+
+    def age_range(self):
+        return range(max(self.ages[0], MIN_AGE), min(self.ages[1], MAX_AGE) + 1)
+
+    def widen_steps(self):
+        """The widening steps that loosen these preferences, in order; gender is never widened."""
+        steps = []
+        if self.ages and self._wider_ages() != self.ages:
+            steps.append("ages")
+        if self.country is not None:
+            steps.append("country")
+        if self.ages:
+            steps.append("any age")
+        return steps
+
+    def widened(self, level):
+        """These preferences after the first `level` widening steps."""
+        steps = self.widen_steps()[:max(level, 0)]
+        if not steps:
+            return self
+        country, ages = self.country, self.ages
+        for step in steps:
+            if step == "ages":
+                ages = self._wider_ages()
+            elif step == "country":
+                country = None
+            else:
+                ages = None
+        return Prefs(self.gender, country, ages)
+
+    def _wider_ages(self):
+        return (max(MIN_AGE, self.ages[0] - WIDEN_AGE), min(MAX_AGE, self.ages[1] + WIDEN_AGE))
+
+    def describe(self):
+        parts = []
+        if self.gender:
+            parts.append(self.gender.lower())
+        if self.country:
+            parts.append(f"from {self.country}")
+        if self.ages:
+            parts.append(f"aged {self.ages[0]}-{self.ages[1]}")
+        return ", ".join(parts) or "anyone"
+
+    def to_json(self):
+        return json.dumps([self.gender, self.country, self.ages]) if self else None
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(*json.loads(text)) if text else cls()
+
+
+class Waiter:
+    __slots__ = ("uid", "gender", "country", "age", "prefs", "seq", "since", "level", "current", "gen")
+
+    def __init__(self, uid, gender, country, age, prefs, seq, since):
+        self.uid = uid
+        self.gender = gender
+        self.country = country
+        self.age = age
+        self.prefs = prefs
+        self.seq = seq
+        self.since = since
+        self.level = 0
+        self.current = prefs  # prefs widened to `level`
+        self.gen = 0  # bumped whenever the waiter is (un)indexed; older heap entries are stale
+
+
+class MatchQueue:
+    def __init__(self, hidden=(), widen_after=None, clock=time.monotonic):
+        self.hidden = set(hidden)
+        self.widen_after = widen_after
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._waiters = {}
+        self._buckets = {}  # (accepts, is) -> [heap of (seq, uid, gen), live entries]
+        self._accepting = {}  # accepts key -> number of waiters indexed under it
+        self._dirty = {}  # uid -> seq, to try on the next match()
+        self._seeking_hidden = set()  # hidden users with preferences, tried on every match()
+        self._widen = []  # heap of (due, seq, uid)
+        self.last_waits = []
+
+    def enqueue(self, uid, gender, opposite=False, country=None, age=None, prefs=None, since=None):
+        """Add a searcher. Returns False if they are already waiting.
+
+        opposite=True is shorthand for preferring the other gender. `since`
+        (on this queue's clock) backdates the wait, so a searcher carried
+        over from elsewhere keeps the widening they had earned.
+        """
+        if gender not in GENDERS:
+            gender = None
+        prefs = prefs or Prefs()
+        if opposite and gender in OPPOSITE:
+            prefs = Prefs(OPPOSITE[gender], prefs.country, prefs.ages)
+        with self._lock:
+            if uid in self._waiters:
+                return False
+            now = self.clock()
+            w = Waiter(uid, gender, country, age, prefs, next(self._seq), now if since is None else since)
+            steps = len(prefs.widen_steps())
+            if self.widen_after and steps:
+                w.level = min(steps, int((now - w.since) // self.widen_after))
+                w.current = prefs.widened(w.level)
+                if w.level < steps:
+                    heapq.heappush(self._widen, (w.since + (w.level + 1) * self.widen_after, w.seq, uid))
+            self._waiters[uid] = w
+            self._index(w)
+            if uid not in self.hidden or prefs:
+                self._dirty[uid] = w.seq
+            if uid in self.hidden and prefs:
+                self._seeking_hidden.add(uid)
+            return True
+
+    def remove(self, uid):
+        with self._lock:
+            return self._take(uid)
+
+    def remove_filtered(self, uid):
+        """Take uid off the queue only if they are searching with preferences."""
+        with self._lock:
+            w = self._waiters.get(uid)
+            if w is None or not w.prefs:
+                return False
+            return self._take(uid)
+
+    def is_waiting(self, uid):
+        return uid in self._waiters
+
+    def __contains__(self, uid):
+        return uid in self._waiters
+
+    def __len__(self):
+        return len(self._waiters)
+
+    def prefs(self, uid):
+        """uid's preferences as widened so far, or None if not waiting."""
+        w = self._waiters.get(uid)
+        return w.current if w else None
+
+    def stats(self):
+        with self._lock:
+            waiters = list(self._waiters.values())
+        counts = {"random": 0, "opposite": 0, "filtered": 0, "hidden": 0}
+        for w in waiters:
+            if w.prefs.country or w.prefs.ages:
+                counts["filtered"] += 1
+            elif w.prefs.gender:
+                counts["opposite"] += 1
+            elif w.uid in self.hidden:
+                counts["hidden"] += 1
+            else:
+                counts["random"] += 1
+        return counts
+
+    def export(self):
+        """Waiting users oldest first, as (uid, gender, opposite, extra); enqueue(uid, gender, **extra) restores one.
+
+        extra["since"] is on this queue's clock.
+        """
+        with self._lock:
+            waiters = sorted(self._waiters.values(), key=lambda w: w.seq)
+        return [(w.uid, w.gender, False, {"country": w.country, "age": w.age, "prefs": w.prefs, "since": w.since})
+                for w in waiters]
+
+    def match(self):
+        """Pair everyone that can be paired right now.
+
+        Only pairs where each side is the other's oldest acceptable partner
+        are formed. Nobody who has waited longer and accepts either of them
+        is passed over. So when a burst of newcomers arrives together, an
+        older opposite-gender seeker still gets first claim on them. Each
+        searcher follows a chain of "oldest acceptable partner" links that
+        get strictly older, until two users point at each other.
+
+        Returns a list of (uid, partner) tuples, with both sides already off
+        the queue. last_waits holds how long each matched user had waited,
+        on this queue's clock.
+        """
+        pairs = []
+        waits = []
+        with self._lock:
+            now = self.clock()
+            self._widen_due()
+            for uid in sorted(self._dirty, key=self._dirty.get):
+                w = self._waiters.get(uid)
+                chain = [w] if w is not None else []
+                while chain:
+                    w = chain[-1]
+                    partner = self._lookup(w)
+                    if partner is None:
+                        break
+                    if len(chain) == 1:
+                        # A waiter from before this pass only accepts users in _dirty, and the
+                        # older ones there are paired or have nobody, so its pick would be w
+                        mutual = partner.uid not in self._dirty
+                    else:
+                        mutual = partner is chain[-2]
+                    # Nobody waits for a hidden searcher, so they take their pick outright
+                    if not mutual and w.uid not in self.hidden:
+                        chain.append(partner)
+                        continue
+                    del chain[-2:]
+                    self._take(w.uid)
+                    self._take(partner.uid)
+                    pairs.append((w.uid, partner.uid))
+                    waits += [now - w.since, now - partner.since]
+            # Hidden searchers are invisible to everyone else's lookups, so they keep looking
+            self._dirty = {uid: self._waiters[uid].seq for uid in self._seeking_hidden}
+            self.last_waits = waits
+        return pairs
+
+    def _lookup(self, w):
+        if w is None:
+            return None
+        self._unindex(w)  # so the lookup can't return w itself
+        partner = self._find(w)
+        self._index(w)
+        return partner
+
+    # Index upkeep
+    def _slots(self, w):
+        if w.uid in self.hidden:
+            return (), ()
+        p = w.current
+        if not p:
+            accepts = (OPEN,)
+        else:
+            wg = p.gender if p.gender is not None else ANY
+            wc = p.country if p.country is not None else ANY
+            accepts = [(wg, wc, a) for a in p.age_range()] if p.ages else [(wg, wc, ANY)]
+        g, c, a = w.gender, w.country, w.age
+        return accepts, (("g", g), ("gc", g, c), ("ga", g, a), ("gca", g, c, a))
+
+    def _index(self, w):
+        w.gen += 1
+        entry = (w.seq, w.uid, w.gen)
+        accepts, attrs = self._slots(w)
+        for key in accepts:
+            self._accepting[key] = self._accepting.get(key, 0) + 1
+            for attr in attrs:
+                bucket = self._buckets.get((key, attr))
+                if bucket is None:
+                    bucket = self._buckets[key, attr] = [[], 0]
+                heapq.heappush(bucket[0], entry)
+                bucket[1] += 1
+
+    def _unindex(self, w):
+        w.gen += 1
+        accepts, attrs = self._slots(w)
+        for key in accepts:
+            self._accepting[key] -= 1
+            if not self._accepting[key]:
+                del self._accepting[key]
+            for attr in attrs:
+                bucket = self._buckets[key, attr]
+                bucket[1] -= 1
+                if not bucket[1]:
+                    del self._buckets[key, attr]
+                elif len(bucket[0]) > 2 * bucket[1] + 16:
+                    bucket[0] = [e for e in bucket[0] if self._live(e)]
+                    heapq.heapify(bucket[0])
+
+    def _live(self, entry):
+        w = self._waiters.get(entry[1])
+        return w is not None and w.gen == entry[2]
+
+    def _head(self, bucket):
+        heap = bucket[0]
+        while heap:
+            if self._live(heap[0]):
+                return self._waiters[heap[0][1]]
+            heapq.heappop(heap)
+        return None
+
+    # Lookup
+    def _attr_keys(self, p):
+        genders = (p.gender,) if p.gender else GENDERS
+        if p.ages and p.country is not None:
+            return [("gca", g, p.country, a) for g in genders for a in p.age_range()]
+        if p.ages:
+            return [("ga", g, a) for g in genders for a in p.age_range()]
+        if p.country is not None:
+            return [("gc", g, p.country) for g in genders]
+        return [("g", g) for g in genders]
+
+    def _find(self, w):
+        """Oldest waiter that w accepts and that accepts w, or None."""
+        attrs = None
+        best = None
+        for key in itertools.product((w.gender, ANY) if w.gender is not None else (ANY,),
+                                     (w.country, ANY) if w.country is not None else (ANY,),
+                                     (w.age, ANY) if w.age is not None else (ANY,)):
+            if key not in self._accepting:
+                continue
+            if attrs is None:
+                attrs = self._attr_keys(w.current)
+            for attr in attrs:
+                bucket = self._buckets.get((key, attr))
+                other = bucket and self._head(bucket)
+                if other and (best is None or other.seq < best.seq):
+                    best = other
+        return best
+
+    def _widen_due(self):
+        now = self.clock()
+        while self._widen and self._widen[0][0] <= now:
+            _, seq, uid = heapq.heappop(self._widen)
+            w = self._waiters.get(uid)
+            if w is None or w.seq != seq:
+                continue
+            self._unindex(w)
+            w.level += 1
+            w.current = w.prefs.widened(w.level)
+            self._index(w)
+            self._dirty[uid] = w.seq
+            if w.level < len(w.prefs.widen_steps()):
+                heapq.heappush(self._widen, (w.since + (w.level + 1) * self.widen_after, w.seq, uid))
+
+    def _take(self, uid):
+        w = self._waiters.get(uid)
+        if w is None:
+            return False
+        self._unindex(w)
+        del self._waiters[uid]
+        self._dirty.pop(uid, None)
+        self._seeking_hidden.discard(uid)
+        return True
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+
+class MatchScheduler:
+    """Runs matching passes on one thread: every `tick` seconds, and as soon as notify() is called.
+
+    run_pass() does one pass and returns (pairs, waits), where waits are the
+    seconds each matched user waited. The thread starts on the first
+    notify(). If waiting() returns 0 when a tick comes round, that pass is
+    skipped. on_pass(pairs, waits) is called after each pass that paired
+    anyone, and stats() reports the latest such pass and the running totals.
+    """
+
+    def __init__(self, run_pass, tick=0.5, waiting=None, on_pass=None):
+        self.run_pass = run_pass
+        self.tick = tick
+        self.waiting = waiting
+        self.on_pass = on_pass
+        self.passes = 0
+        self.matched = 0
+        self.errors = 0
+        self.last = {}
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def notify(self):
+        if self._thread is None:
+            self.start()
+        self._wake.set()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="matchmaker", daemon=True)
+                self._thread.start()
+
+    def run_once(self):
+        try:
+            pairs, waits = self.run_pass()
+        except Exception:
+            self.errors += 1
+            logger.exception("Match pass failed")
+            return []
+        self.passes += 1
+        if pairs:
+            self.matched += len(pairs)
+            self.last = {"pairs": len(pairs), "wait_p50": percentile(waits, 0.5), "wait_p95": percentile(waits, 0.95),
+                         "wait_max": max(waits, default=0.0), "at": time.time()}
+            if self.on_pass:
+                try:
+                    self.on_pass(pairs, waits)
+                except Exception:
+                    logger.exception("Match pass callback failed")
+        return pairs
+
+    def stats(self):
+        return {"running": self._thread is not None, "tick": self.tick, "passes": self.passes,
+                "matched": self.matched, "errors": self.errors, "last": self.last}
+
+    def _run(self):
+        while True:
+            signalled = self._wake.wait(self.tick)
+            self._wake.clear()
+            try:
+                if not signalled and self.waiting is not None and not self.waiting():
+                    continue
+            except Exception:
+                pass
+            self.run_once()
@@ -0,0 +1,287 @@
+"""
+Rate-limited outbound queue for Telegram sends.
+
+Telegram allows roughly 30 messages/s per bot and about 1 message/s per
+chat before answering 429. Every send is queued here, paced by a global
+token bucket and a per-chat one, and handed to a few sender threads.
+Each chat's sends form a FIFO: only its oldest job is scheduled, and the
+next one once that is done, so a chat never has two sends in flight and
+its messages arrive in order. Across chats, relay goes ahead of
+notifications, and both go ahead of bulk sends. A 429 waits out its
+retry_after, and network or 5xx errors are retried with backoff. Callers
+get a Future, or use call() to block for the result exactly like a direct
+API call. Handlers should prefer submit(): a chat's backlog then only
+delays that chat. Sends still queued when close() gives up fail with
+OutboxClosed, and after that a send gets one inline attempt and no retries.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import requests
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_RELAY = 0
+PRIORITY_NOTIFY = 1
+PRIORITY_BULK = 2  # broadcasts: only sent when nothing else is waiting
+
+
+class OutboxClosed(Exception):
+    """The outbox shut down before this send went out."""
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self):
+        """Take a token, going into debt if needed. Returns seconds to wait before using it."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def idle(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.burst
+
+
+class _Chat:
+    __slots__ = ("bucket", "queue", "active")
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = deque()  # jobs waiting behind the active one
+        self.active = False  # one of its jobs is scheduled, being sent or waiting to retry
+
+
+class _Job:
+    __slots__ = ("fn", "chat_id", "args", "kwargs", "priority", "future", "created", "attempts")
+
+    def __init__(self, fn, chat_id, args, kwargs, priority):
+        self.fn = fn
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.created = time.monotonic()
+        self.attempts = 0
+
+
+class Outbox:
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, workers=4, max_retries=3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}  # chat_id -> _Chat, under _cond
+        self._queued = 0  # jobs in the chats' queues
+        self._ready = []
+        self._delayed = []
+        self._busy = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._latency = deque(maxlen=1000)
+        self._threads = []
+        self._closed = False
+
+    def submit(self, fn, chat_id, *args, priority=PRIORITY_NOTIFY, **kwargs):
+        job = _Job(fn, chat_id, args, kwargs, priority)
+        if self._closed:
+            # Shutting down: nobody is left to drain the queue, send inline
+            self._send(job)
+            return job.future
+        with self._cond:
+            chat = self._chat(chat_id)
+            chat.queue.append(job)
+            self._queued += 1
+            if not chat.active:
+                self._activate(chat)
+        return job.future
+
+    def call(self, fn, chat_id, *args, priority=PRIORITY_NOTIFY, **kwargs):
+        return self.submit(fn, chat_id, *args, priority=priority, **kwargs).result()
+
+    def depth(self):
+        with self._cond:
+            return len(self._ready) + len(self._delayed) + self._busy + self._queued
+
+    def stats(self):
+        lat = sorted(self._latency)
+        pct = lambda p: round(lat[min(len(lat) - 1, int(p * len(lat)))] * 1000, 1) if lat else 0.0
+        return {
+            "depth": self.depth(), "sent": self.sent, "failed": self.failed,
+            "retried": self.retried, "throttled": self.throttled,
+            "latency_ms": {"p50": pct(0.5), "p95": pct(0.95), "max": pct(1.0)},
+        }
+
+    def close(self, timeout=5):
+        """Give queued sends up to `timeout` seconds to go out, then stop the senders.
+
+        Whatever is still queued then fails with OutboxClosed, so no caller
+        is left waiting on a future that never resolves.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._ready or self._delayed or self._busy or self._queued) and time.monotonic() < deadline:
+                self._cond.wait(0.05)
+            self._closed = True
+            left = [entry[2] for entry in self._ready + self._delayed]
+            self._ready, self._delayed = [], []
+            for chat in self._chats.values():
+                left.extend(chat.queue)
+                chat.queue.clear()
+                chat.active = False
+            self._queued = 0
+            self._cond.notify_all()
+        if left:
+            logger.warning(f"Outbox closed with {len(left)} send(s) still queued")
+        for job in left:
+            self.failed += 1
+            job.future.set_exception(OutboxClosed(f"send to {job.chat_id} dropped at shutdown"))
+
+    def _chat(self, chat_id):
+        # Under _cond
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) > 10000:
+                for cid, c in list(self._chats.items()):
+                    if not c.active and c.bucket.idle():
+                        del self._chats[cid]
+            chat = self._chats[chat_id] = _Chat(self.chat_rate, self.chat_burst)
+        return chat
+
+    def _activate(self, chat):
+        # Under _cond: schedule the chat's next job once its bucket allows
+        job = chat.queue.popleft()
+        self._queued -= 1
+        chat.active = True
+        self._push(job, chat.bucket.reserve())
+
+    def _done(self, job):
+        with self._cond:
+            chat = self._chats.get(job.chat_id)
+            if chat is None:
+                return
+            if chat.queue and not self._closed:
+                self._activate(chat)
+            else:
+                chat.active = False
+
+    def _schedule(self, job, delay, error):
+        with self._cond:
+            if not self._closed:
+                self._push(job, delay)
+                return
+        self._fail(job, error)
+
+    def _push(self, job, delay):
+        # Under _cond
+        if not self._threads:
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        if delay > 0:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), job))
+        else:
+            heapq.heappush(self._ready, (job.priority, next(self._seq), job))
+        self._cond.notify()
+
+    def _next(self):
+        with self._cond:
+            while not self._closed:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, job = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (job.priority, seq, job))
+                if self._ready:
+                    self._busy += 1
+                    return heapq.heappop(self._ready)[2]
+                self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+            return None
+
+    def _run(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            try:
+                wait = self._global.reserve()
+                if wait:
+                    time.sleep(wait)
+                self._send(job)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._cond.notify_all()
+
+    def _send(self, job):
+        job.attempts += 1
+        try:
+            result = job.fn(job.chat_id, *job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                self.throttled += 1
+                with self._cond:
+                    chat = self._chats.get(job.chat_id)
+                if chat is not None:
+                    chat.bucket.pause(retry_after)
+                self._retry(job, retry_after, e, limit=self.max_retries + 2)
+            elif e.error_code >= 500:
+                self._retry(job, 0.5 * 2 ** job.attempts, e)
+            else:
+                self._fail(job, e, quiet=True)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self._retry(job, 0.5 * 2 ** job.attempts, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            self._latency.append(time.monotonic() - job.created)
+            self._done(job)
+            job.future.set_result(result)
+
+    def _retry(self, job, delay, error, limit=None):
+        if job.attempts > (limit or self.max_retries) or self._closed:
+            # After close() nobody is left to wait out the delay
+            self._fail(job, error)
+            return
+        self.retried += 1
+        self._schedule(job, delay, error)
+
+    def _fail(self, job, error, quiet=False):
+        # 4xx answers (blocked bot, bad file id...) are the caller's to handle
+        self.failed += 1
+        log = logger.debug if quiet else logger.warning
+        log(f"Send to {job.chat_id} failed after {job.attempts} attempt(s): {error}")
+        self._done(job)
+        job.future.set_exception(error)
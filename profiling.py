@@ -0,0 +1,248 @@
+"""
+On-demand profiling of bot handlers.
+
+Profiler sits idle until start(). While idle it costs each handler call one
+attribute check. A run profiles every top-level handler call in one of two modes:
+
+    cprofile   cProfile around each call: exact call counts and times, but
+               handlers run a few times slower while it is on
+    sample     a thread snapshots the stacks of threads inside a handler
+               every `interval` seconds: statistical, cheap enough for a
+               busy bot
+
+A run stops after a given number of handler calls or seconds, or on stop().
+It then writes its results to a new directory under `directory` and passes a
+plain-text summary to on_done:
+
+    cprofile   <handler>.pstats for each handler plus all.pstats
+               (python -m pstats, snakeviz)
+    sample     stacks.collapsed, one "handler;frame;...;frame count" line
+               per distinct stack (flamegraph.pl, speedscope)
+
+Functions a handler calls, such as enqueue_search(), show up inside that
+handler's profile.
+
+From Python 3.12 only one cProfile can be enabled per process at a time, so
+there a cprofile run profiles one handler call at a time; calls on other
+threads that overlap it run unprofiled and don't count towards the run.
+"""
+
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+MODES = ("cprofile", "sample")
+ONE_CPROFILE = sys.version_info >= (3, 12)
+
+
+def _frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class _Run:
+    def __init__(self, mode, updates, seconds, on_done):
+        self.mode = mode
+        self.updates = updates
+        self.seconds = seconds
+        self.on_done = on_done
+        self.started = time.time()
+        self.done = False
+        self.admitted = 0
+        self.finished = 0
+        self.calls = Counter()  # handler -> calls
+        self.wall = Counter()  # handler -> seconds
+        self.stats = {}  # handler -> pstats.Stats (cprofile)
+        self.stacks = Counter()  # collapsed stack -> samples (sample)
+        self.threads = {}  # thread ident -> (handler, code of the handler function) (sample)
+        self.lock = threading.Lock()
+
+    def admit(self):
+        with self.lock:
+            if self.done or (self.updates and self.admitted >= self.updates):
+                return False
+            self.admitted += 1
+            return True
+
+    def record(self, name, seconds, prof=None):
+        """Account one finished call; True once the run has reached its call limit."""
+        if prof is not None:
+            prof.create_stats()
+        with self.lock:
+            if self.done:
+                return False
+            self.calls[name] += 1
+            self.wall[name] += seconds
+            if prof is not None:
+                if name in self.stats:
+                    self.stats[name].add(prof)
+                else:
+                    self.stats[name] = pstats.Stats(prof)
+            self.finished += 1
+            return bool(self.updates) and self.finished >= self.updates
+
+
+class Profiler:
+    def __init__(self, directory, interval=0.005, top=15):
+        self.directory = directory
+        self.interval = interval
+        self.top = top
+        self.active = False
+        self._run = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._cprofile = threading.Lock()  # held by the call being cProfiled when ONE_CPROFILE
+
+    def start(self, mode="sample", updates=None, seconds=None, on_done=None):
+        """Begin a run ending after `updates` handler calls or `seconds`, whichever comes first.
+
+        Returns False if a run is already going.
+        """
+        if mode not in MODES:
+            raise ValueError(f"unknown profile mode '{mode}' ({' or '.join(MODES)})")
+        with self._lock:
+            if self.active:
+                return False
+            run = self._run = _Run(mode, updates, seconds, on_done)
+            self.active = True
+        if mode == "sample":
+            threading.Thread(target=self._sample, args=(run,), name="profiler", daemon=True).start()
+        if seconds:
+            timer = threading.Timer(seconds, self._finish, args=(run,))
+            timer.daemon = True
+            timer.start()
+        return True
+
+    def stop(self):
+        """End the current run now; its summary, or None if nothing was running."""
+        run = self._run
+        return self._finish(run) if run is not None else None
+
+    def status(self):
+        run = self._run
+        if run is None or run.done:
+            return None
+        return {"mode": run.mode, "calls": run.finished, "updates": run.updates, "seconds": run.seconds,
+                "elapsed": time.time() - run.started}
+
+    def run(self, name, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) under the current run as handler `name`."""
+        run = self._run
+        # Handlers calling other handlers are already inside the outer call's profile
+        if run is None or getattr(self._local, "busy", False):
+            return fn(*args, **kwargs)
+        exclusive = run.mode == "cprofile" and ONE_CPROFILE
+        if exclusive and not self._cprofile.acquire(blocking=False):
+            return fn(*args, **kwargs)
+        try:
+            if not run.admit():
+                return fn(*args, **kwargs)
+            return self._profiled(run, name, fn, args, kwargs)
+        finally:
+            if exclusive:
+                self._cprofile.release()
+
+    def _profiled(self, run, name, fn, args, kwargs):
+        self._local.busy = True
+        prof = None
+        start = time.perf_counter()
+        try:
+            if run.mode == "cprofile":
+                prof = cProfile.Profile()
+                return prof.runcall(fn, *args, **kwargs)
+            ident = threading.get_ident()
+            run.threads[ident] = (name, getattr(fn, "__code__", None))
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                run.threads.pop(ident, None)
+        finally:
+            self._local.busy = False
+            if run.record(name, time.perf_counter() - start, prof):
+                self._finish(run)
+
+    def _sample(self, run):
+        while not run.done:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            stacks = []
+            for ident, (name, code) in list(run.threads.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    if frame.f_code is code:
+                        break
+                    frame = frame.f_back
+                stack.append(name)
+                stacks.append(";".join(reversed(stack)))
+            del frames
+            with run.lock:
+                if not run.done:
+                    run.stacks.update(stacks)
+
+    def _finish(self, run):
+        with self._lock, run.lock:
+            if run.done:
+                return None
+            run.done = True
+            if self._run is run:
+                self.active = False
+        path = os.path.join(self.directory, time.strftime("%Y%m%d-%H%M%S", time.localtime(run.started))
+                            + "-" + run.mode)
+        os.makedirs(path, exist_ok=True)
+        if run.mode == "cprofile":
+            summary = self._write_cprofile(run, path)
+        else:
+            summary = self._write_samples(run, path)
+        if run.on_done:
+            try:
+                run.on_done(summary)
+            except Exception:
+                pass
+        return summary
+
+    def _header(self, run, path):
+        lines = [f"{run.mode}: {run.finished} handler calls in {time.time() - run.started:.1f}s", f"Saved to {path}", ""]
+        for name, calls in run.calls.most_common():
+            lines.append(f"{name}: {calls}x, avg {run.wall[name] / calls * 1000:.1f} ms")
+        return lines
+
+    def _write_cprofile(self, run, path):
+        for name, stats in run.stats.items():
+            stats.dump_stats(os.path.join(path, f"{name}.pstats"))
+        lines = self._header(run, path)
+        if not run.stats:
+            return "\n".join(lines)
+        combined = pstats.Stats()
+        combined.add(*run.stats.values())
+        combined.dump_stats(os.path.join(path, "all.pstats"))
+        lines += ["", f"Top {self.top} by own time (own / cumulative ms, calls):"]
+        rows = sorted(combined.stats.items(), key=lambda kv: kv[1][2], reverse=True)[:self.top]
+        for (filename, line, func), (cc, nc, tt, ct, callers) in rows:
+            where = f"{os.path.basename(filename)}:{line} {func}" if line else re.sub(r" at 0x[0-9a-f]+", "", func)
+            lines.append(f"{tt * 1000:8.1f} {ct * 1000:8.1f} {nc:6}  {where}")
+        return "\n".join(lines)
+
+    def _write_samples(self, run, path):
+        with open(os.path.join(path, "stacks.collapsed"), "w") as f:
+            for stack, count in run.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        own = Counter()
+        total = Counter()
+        for stack, count in run.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for frame in set(frames[1:]):
+                total[frame] += count
+        samples = sum(run.stacks.values())
+        lines = self._header(run, path)
+        lines += ["", f"{samples} samples every {self.interval * 1000:g} ms",
+                  f"Top {self.top} by own samples (own / on stack):"]
+        for frame, count in own.most_common(self.top):
+            lines.append(f"{count / samples * 100:5.1f}% {total[frame] / samples * 100:5.1f}%  {frame}")
+        return "\n".join(lines)
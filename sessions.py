@@ -0,0 +1,482 @@
+"""
+Session state backends.
+
+A backend owns the state that has to agree across every process serving
+updates: the match queue, live pairs, pending media consent, the prompt
+trackers (report reason, country), reconnect offers and TeleBot's
+next-step handlers.
+
+MemoryBackend keeps all of it in process, as the bot always did, and is
+the right choice for a single worker. SqliteBackend keeps it in one
+SQLite file that several gunicorn workers on the same box open together.
+Pairing runs inside BEGIN IMMEDIATE, which holds the file's write lock
+from reading the queue to writing the pairs, so two workers can never
+both claim the same user. Each process keeps its own MatchQueue mirror of
+the waiting table between passes, and catches up on new rows (by seq) and
+removed ones (logged to waiting_gone by a trigger) at the start of each.
+
+Values in the kv table are JSON. A next-step handler is stored by the
+module and name of its callback, which must be a module-level function in
+one of the backend's handler_modules; nothing else is looked up when the
+table is read back.
+"""
+
+import json
+import math
+import sqlite3
+import sys
+import threading
+import time
+import types
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+from telebot import Handler
+from telebot.handler_backends import HandlerBackend
+
+from matchmaking import OPPOSITE, WIDEN_STEPS, MatchQueue, Prefs
+from ttlmap import TTLMap
+
+
+class SessionBackend:
+    """Interface shared by the backends.
+
+    Attributes: queue (MatchQueue-like), pairs (mapping uid -> partner),
+    pending_media / report_reason_pending / pending_country / reconnect
+    (TTLMap-like), handlers (TeleBot next-step backend, or None for
+    TeleBot's default).
+    """
+
+    shared = False
+    last_waits = ()  # seconds each user paired by the last claim_matches() had waited
+
+    def claim_matches(self):
+        """Pair everyone the queue can pair and record them in pairs. Returns [(uid, partner)]."""
+        raise NotImplementedError()
+
+    def pair(self, a, b):
+        raise NotImplementedError()
+
+    def unpair(self, uid):
+        """End uid's chat. Returns the partner, or None if uid wasn't chatting."""
+        raise NotImplementedError()
+
+
+class MemoryBackend(SessionBackend):
+    def __init__(self, hidden=(), widen_after=None, pending_media_ttl=3600, prompt_ttl=1800, reconnect_ttl=300):
+        self.queue = MatchQueue(hidden, widen_after=widen_after)
+        self.pairs = {}
+        self.pending_media = TTLMap(ttl=pending_media_ttl)
+        self.report_reason_pending = TTLMap(ttl=prompt_ttl)
+        self.pending_country = TTLMap(ttl=prompt_ttl)
+        self.reconnect = TTLMap(ttl=reconnect_ttl)
+        self.handlers = None
+        self._lock = threading.Lock()
+
+    def claim_matches(self):
+        with self._lock:
+            pairs = self.queue.match()
+            self.last_waits = self.queue.last_waits
+            for a, b in pairs:
+                self.pairs[a] = b
+                self.pairs[b] = a
+            return pairs
+
+    def pair(self, a, b):
+        with self._lock:
+            self.pairs[a] = b
+            self.pairs[b] = a
+
+    def unpair(self, uid):
+        with self._lock:
+            partner = self.pairs.pop(uid, None)
+            if partner is not None and self.pairs.get(partner) == uid:
+                del self.pairs[partner]
+            return partner
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS waiting (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid INTEGER UNIQUE NOT NULL,
+    gender TEXT,
+    opposite INTEGER NOT NULL DEFAULT 0,
+    country TEXT,
+    age INTEGER,
+    prefs TEXT,
+    since REAL
+);
+CREATE TABLE IF NOT EXISTS pairs (
+    uid INTEGER PRIMARY KEY,
+    partner INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kv (
+    ns TEXT NOT NULL,
+    key NOT NULL,
+    value BLOB,
+    expires REAL,
+    PRIMARY KEY (ns, key)
+);
+CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires);
+CREATE TABLE IF NOT EXISTS waiting_gone (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid INTEGER NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS waiting_gone_at ON waiting_gone (at);
+CREATE TRIGGER IF NOT EXISTS waiting_removed AFTER DELETE ON waiting BEGIN
+    INSERT INTO waiting_gone (uid, at) VALUES (old.uid, (julianday('now') - 2440587.5) * 86400.0);
+END;
+"""
+
+GONE_KEEP_SECONDS = 600  # a mirror older than half this is rebuilt rather than caught up
+
+
+class SqliteBackend(SessionBackend):
+    shared = True
+
+    def __init__(self, path, hidden=(), widen_after=None, pending_media_ttl=3600, prompt_ttl=1800, reconnect_ttl=300,
+                 handler_modules=()):
+        self.path = path
+        self.hidden = set(hidden)
+        self.widen_after = widen_after
+        self._local = threading.local()
+        self._mirror = None  # MatchQueue copy of waiting, as of _synced_at
+        self._seen_seq = 0
+        self._seen_gone = 0
+        self._synced_at = 0.0
+        c = self.conn()
+        c.executescript(SCHEMA)
+        # Rows pickled by older versions; they are short-lived prompts and steps
+        c.execute("DELETE FROM kv WHERE typeof(value) = 'blob'")
+        # Files from before match preferences
+        columns = {row[1] for row in c.execute("PRAGMA table_info(waiting)")}
+        for column, decl in (("country", "TEXT"), ("age", "INTEGER"), ("prefs", "TEXT"), ("since", "REAL")):
+            if column not in columns:
+                c.execute(f"ALTER TABLE waiting ADD COLUMN {column} {decl}")
+        self.queue = SqliteQueue(self)
+        self.pairs = SqlitePairs(self)
+        self.pending_media = SqliteTTLMap(self, "pending_media", pending_media_ttl)
+        self.report_reason_pending = SqliteTTLMap(self, "report_reason", prompt_ttl)
+        self.pending_country = SqliteTTLMap(self, "pending_country", prompt_ttl)
+        self.reconnect = SqliteTTLMap(self, "reconnect", reconnect_ttl)
+        self.handlers = SqliteHandlerBackend(SqliteTTLMap(self, "next_step", 24 * 3600, handler_modules))
+
+    def conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            # Autocommit; transaction() opens explicit BEGIN IMMEDIATE blocks
+            c = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = c
+        return c
+
+    @contextmanager
+    def transaction(self):
+        c = self.conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            yield c
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+
+    def claim_matches(self):
+        # Matching itself is MatchQueue's; this only makes it atomic across processes
+        with self.transaction() as c:
+            queue = self._sync(c)
+            pairs = queue.match()
+            self.last_waits = queue.last_waits
+            for a, b in pairs:
+                c.execute("DELETE FROM waiting WHERE uid IN (?, ?)", (a, b))
+                c.executemany("INSERT OR REPLACE INTO pairs (uid, partner) VALUES (?, ?)", ((a, b), (b, a)))
+        return pairs
+
+    def _sync(self, c):
+        """Bring the mirror up to date with the waiting table. Runs inside claim_matches' transaction."""
+        now = time.time()
+        if self._mirror is None or now - self._synced_at > GONE_KEEP_SECONDS / 2:
+            self._mirror = MatchQueue(self.hidden, widen_after=self.widen_after, clock=time.time)
+            self._seen_seq = 0
+            self._seen_gone = c.execute("SELECT COALESCE(MAX(id), 0) FROM waiting_gone").fetchone()[0]
+        else:
+            # Removals first: a uid that left and came back has a newer seq, added below
+            for gone_id, uid in c.execute("SELECT id, uid FROM waiting_gone WHERE id > ? ORDER BY id",
+                                          (self._seen_gone,)).fetchall():
+                self._mirror.remove(uid)
+                self._seen_gone = gone_id
+        rows = c.execute("""
+            SELECT seq, uid, gender, opposite, country, age, prefs, since FROM waiting WHERE seq > ? ORDER BY seq
+        """, (self._seen_seq,)).fetchall()
+        for seq, uid, gender, opposite, country, age, prefs, since in rows:
+            self._mirror.enqueue(uid, gender, opposite=bool(opposite), country=country, age=age,
+                                 prefs=Prefs.from_json(prefs), since=since)
+            self._seen_seq = seq
+        c.execute("DELETE FROM waiting_gone WHERE at < ?", (now - GONE_KEEP_SECONDS,))
+        self._synced_at = now
+        return self._mirror
+
+    def pair(self, a, b):
+        with self.transaction() as c:
+            c.executemany("INSERT OR REPLACE INTO pairs (uid, partner) VALUES (?, ?)", ((a, b), (b, a)))
+
+    def unpair(self, uid):
+        with self.transaction() as c:
+            row = c.execute("SELECT partner FROM pairs WHERE uid=?", (uid,)).fetchone()
+            if row is None:
+                return None
+            partner = row[0]
+            c.execute("DELETE FROM pairs WHERE uid=?", (uid,))
+            c.execute("DELETE FROM pairs WHERE uid=? AND partner=?", (partner, uid))
+            return partner
+
+
+class SqliteQueue:
+    clock = staticmethod(time.time)  # since in the waiting table is wall-clock time
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def enqueue(self, uid, gender, opposite=False, country=None, age=None, prefs=None, since=None):
+        prefs = prefs or Prefs()
+        c = self.backend.conn()
+        cur = c.execute("""
+            INSERT OR IGNORE INTO waiting (uid, gender, opposite, country, age, prefs, since)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (uid, gender, int(opposite), country, age, prefs.to_json(), time.time() if since is None else since))
+        return cur.rowcount == 1
+
+    def remove(self, uid):
+        return self.backend.conn().execute("DELETE FROM waiting WHERE uid=?", (uid,)).rowcount == 1
+
+    def remove_filtered(self, uid):
+        c = self.backend.conn()
+        return c.execute("DELETE FROM waiting WHERE uid=? AND (opposite=1 OR prefs IS NOT NULL)", (uid,)).rowcount == 1
+
+    def prefs(self, uid):
+        row = self.backend.conn().execute("SELECT gender, opposite, prefs, since FROM waiting WHERE uid=?",
+                                          (uid,)).fetchone()
+        if row is None:
+            return None
+        gender, opposite, prefs, since = row
+        prefs = Prefs.from_json(prefs)
+        if opposite and gender in OPPOSITE:
+            prefs = Prefs(OPPOSITE[gender], prefs.country, prefs.ages)
+        widen_after = self.backend.widen_after
+        if widen_after and since is not None:
+            prefs = prefs.widened(min(WIDEN_STEPS, int((time.time() - since) // widen_after)))
+        return prefs
+
+    def is_waiting(self, uid):
+        return self.backend.conn().execute("SELECT 1 FROM waiting WHERE uid=?", (uid,)).fetchone() is not None
+
+    __contains__ = is_waiting
+
+    def __len__(self):
+        return self.backend.conn().execute("SELECT COUNT(*) FROM waiting").fetchone()[0]
+
+    def stats(self):
+        counts = {"random": 0, "opposite": 0, "filtered": 0, "hidden": 0}
+        for uid, opposite, prefs in self.backend.conn().execute("SELECT uid, opposite, prefs FROM waiting"):
+            prefs = Prefs.from_json(prefs)
+            if prefs.country or prefs.ages:
+                counts["filtered"] += 1
+            elif opposite or prefs.gender:
+                counts["opposite"] += 1
+            elif uid in self.backend.hidden:
+                counts["hidden"] += 1
+            else:
+                counts["random"] += 1
+        return counts
+
+    def export(self):
+        rows = self.backend.conn().execute("SELECT uid, gender, opposite, country, age, prefs, since FROM waiting ORDER BY seq")
+        return [(uid, gender, bool(opp), {"country": country, "age": age, "prefs": Prefs.from_json(prefs), "since": since})
+                for uid, gender, opp, country, age, prefs, since in rows]
+
+
+class SqlitePairs(MutableMapping):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getitem__(self, uid):
+        row = self.backend.conn().execute("SELECT partner FROM pairs WHERE uid=?", (uid,)).fetchone()
+        if row is None:
+            raise KeyError(uid)
+        return row[0]
+
+    def __setitem__(self, uid, partner):
+        self.backend.conn().execute("INSERT OR REPLACE INTO pairs (uid, partner) VALUES (?, ?)", (uid, partner))
+
+    def __delitem__(self, uid):
+        if self.backend.conn().execute("DELETE FROM pairs WHERE uid=?", (uid,)).rowcount == 0:
+            raise KeyError(uid)
+
+    def __contains__(self, uid):
+        return self.backend.conn().execute("SELECT 1 FROM pairs WHERE uid=?", (uid,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([uid for uid, in self.backend.conn().execute("SELECT uid FROM pairs")])
+
+    def __len__(self):
+        return self.backend.conn().execute("SELECT COUNT(*) FROM pairs").fetchone()[0]
+
+
+def dump_value(value):
+    """JSON text for a kv value; raises TypeError for anything else."""
+    return json.dumps(value, separators=(",", ":"), default=_dump_handler)
+
+
+def load_value(text, handler_modules=()):
+    return json.loads(text, object_hook=lambda obj: _load_handler(obj, handler_modules))
+
+
+def _dump_handler(obj):
+    if isinstance(obj, Handler):
+        name = getattr(obj.callback, "__qualname__", "")
+        if not name.isidentifier():
+            raise TypeError(f"next-step callback {obj.callback!r} is not a module-level function")
+        return {"__handler__": f"{obj.callback.__module__}:{name}", "args": obj.args, "kwargs": obj.kwargs}
+    raise TypeError(f"{type(obj).__name__} can't be stored in the session database")
+
+
+def _load_handler(obj, handler_modules):
+    name = obj.get("__handler__")
+    if name is None:
+        return obj
+    module, _, attr = name.partition(":")
+    callback = None
+    if module in handler_modules and attr.isidentifier():
+        callback = getattr(sys.modules.get(module), attr, None)
+    if not isinstance(callback, types.FunctionType) or callback.__module__ != module:
+        raise ValueError(f"unknown next-step callback {name}")
+    return Handler(callback, *obj["args"], **obj["kwargs"])
+
+
+class SqliteTTLMap:
+    """TTLMap's interface over one namespace of the kv table; values are JSON, expiry is wall clock.
+
+    Like TTLMap, every write also deletes what has expired, here across all
+    namespaces through the expires index, so dead rows never pile up.
+    """
+
+    def __init__(self, backend, ns, ttl=None, handler_modules=()):
+        self.backend = backend
+        self.ns = ns
+        self.ttl = ttl
+        self.handler_modules = frozenset(handler_modules)
+
+    def set(self, key, value, ttl=None, deadline=None):
+        if deadline is None:
+            ttl = self.ttl if ttl is None else ttl
+            deadline = time.time() + ttl if ttl is not None else math.inf
+        expires = None if deadline == math.inf else deadline
+        c = self.backend.conn()
+        c.execute("INSERT OR REPLACE INTO kv (ns, key, value, expires) VALUES (?, ?, ?, ?)",
+                  (self.ns, key, dump_value(value), expires))
+        c.execute("DELETE FROM kv WHERE expires <= ?", (time.time(),))
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def get(self, key, default=None):
+        row = self.backend.conn().execute(
+            "SELECT value FROM kv WHERE ns=? AND key=? AND (expires IS NULL OR expires > ?)",
+            (self.ns, key, time.time())).fetchone()
+        return load_value(row[0], self.handler_modules) if row else default
+
+    def __getitem__(self, key):
+        marker = object()
+        value = self.get(key, marker)
+        if value is marker:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.backend.conn().execute(
+            "SELECT 1 FROM kv WHERE ns=? AND key=? AND (expires IS NULL OR expires > ?)",
+            (self.ns, key, time.time())).fetchone() is not None
+
+    def pop(self, key, default=None):
+        with self.backend.transaction() as c:
+            row = c.execute("SELECT value, expires FROM kv WHERE ns=? AND key=?", (self.ns, key)).fetchone()
+            if row is None:
+                return default
+            c.execute("DELETE FROM kv WHERE ns=? AND key=?", (self.ns, key))
+        value, expires = row
+        if expires is not None and expires <= time.time():
+            return default
+        return load_value(value, self.handler_modules)
+
+    def __delitem__(self, key):
+        marker = object()
+        if self.pop(key, marker) is marker:
+            raise KeyError(key)
+
+    def add(self, key, ttl=None):
+        self.set(key, True, ttl=ttl)
+
+    def discard(self, key):
+        self.pop(key)
+
+    def items(self):
+        rows = self.backend.conn().execute(
+            "SELECT key, value FROM kv WHERE ns=? AND (expires IS NULL OR expires > ?)",
+            (self.ns, time.time())).fetchall()
+        return [(k, load_value(v, self.handler_modules)) for k, v in rows]
+
+    def __len__(self):
+        return self.backend.conn().execute(
+            "SELECT COUNT(*) FROM kv WHERE ns=? AND (expires IS NULL OR expires > ?)",
+            (self.ns, time.time())).fetchone()[0]
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        # The (ns, key) key would have it walk the whole namespace
+        return self.backend.conn().execute(
+            "DELETE FROM kv INDEXED BY kv_expires WHERE expires <= ? AND ns=?", (now, self.ns)).rowcount
+
+    def stats(self):
+        return {"size": len(self)}
+
+
+class SqliteHandlerBackend(HandlerBackend):
+    """TeleBot next-step handlers stored in the shared kv table, so any worker can run the next step."""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self.handlers = store  # `chat_id in backend.handlers` works as for TeleBot's own backends
+
+    def register_handler(self, handler_group_id, handler):
+        with self.store.backend.transaction():
+            try:
+                handlers = self.store.get(handler_group_id) or []
+            except ValueError:
+                handlers = []
+            handlers.append(handler)
+            self.store.set(handler_group_id, handlers)
+
+    def clear_handlers(self, handler_group_id):
+        self.store.discard(handler_group_id)
+
+    def get_handlers(self, handler_group_id):
+        # TeleBot asks on every message and almost none have a step pending, so look
+        # with a plain read before taking the write lock
+        if handler_group_id not in self.store:
+            return None
+        try:
+            return self.store.pop(handler_group_id)
+        except ValueError:
+            return None  # its callback no longer exists, e.g. renamed by a deploy
+
+
+def open_sessions(kind, path=None, handler_modules=(), **kwargs):
+    """handler_modules: modules whose functions may be restored as next-step callbacks (sqlite only)."""
+    if kind == "memory":
+        return MemoryBackend(**kwargs)
+    if kind == "sqlite":
+        return SqliteBackend(path, handler_modules=handler_modules, **kwargs)
+    raise ValueError(f"unknown session backend '{kind}' (memory or sqlite)")
@@ -0,0 +1,132 @@
+"""
+Dictionary with per-entry expiry.
+
+Deadlines live in a min-heap next to the dict. Every write sweeps the
+entries that are due off the top of the heap, so each expiry is paid
+once (amortised O(log n)) instead of scanning the whole map. Reads also
+check the entry they touch, so an expired value is never returned even
+between sweeps; only sweep() removes them, so on_expire fires once per
+expired entry. Heap entries left behind when a key is overwritten or
+removed are skipped on pop and compacted away if they pile up.
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+
+
+class TTLMap:
+    def __init__(self, ttl=None, clock=time.monotonic, on_expire=None):
+        self.ttl = ttl
+        self.clock = clock
+        self.on_expire = on_expire
+        self.expired = 0
+        self._data = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.RLock()
+
+    def set(self, key, value, ttl=None, deadline=None):
+        """Store `value`; it expires at `deadline`, else after `ttl` (or the map's ttl), else never."""
+        if deadline is None:
+            ttl = self.ttl if ttl is None else ttl
+            deadline = self.clock() + ttl if ttl is not None else math.inf
+        with self._lock:
+            self._data[key] = (deadline, value)
+            if deadline != math.inf:
+                heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        self.sweep()
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= self.clock():
+                # Due but not swept yet; sweep() removes it and fires on_expire
+                return default
+            return item[1]
+
+    def __getitem__(self, key):
+        marker = object()
+        value = self.get(key, marker)
+        if value is marker:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        marker = object()
+        return self.get(key, marker) is not marker
+
+    def deadline(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item[0] if item else None
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self.get(key, default)
+            self._data.pop(key, None)
+            return value
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self:
+                raise KeyError(key)
+            del self._data[key]
+
+    # Set-style use, for maps that only track membership
+    def add(self, key, ttl=None):
+        self.set(key, True, ttl=ttl)
+
+    def discard(self, key):
+        self.pop(key)
+
+    def items(self):
+        self.sweep()
+        with self._lock:
+            return [(k, v) for k, (_, v) in self._data.items()]
+
+    def __len__(self):
+        self.sweep()
+        return len(self._data)
+
+    def sweep(self, now=None):
+        """Drop every entry that is due. Returns how many expired."""
+        now = self.clock() if now is None else now
+        gone = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(heap)
+                item = self._data.get(key)
+                if item is not None and item[0] == deadline:
+                    del self._data[key]
+                    gone.append((key, item[1]))
+            if len(heap) > 2 * len(self._data) + 64:
+                self._heap = [(d, next(self._seq), k) for k, (d, _) in self._data.items() if d != math.inf]
+                heapq.heapify(self._heap)
+            self.expired += len(gone)
+        if self.on_expire:
+            for key, value in gone:
+                self.on_expire(key, value)
+        return len(gone)
+
+    def next_deadline(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def export(self):
+        """Live entries as (key, value, seconds left or None) - portable across clocks and restarts."""
+        now = self.clock()
+        with self._lock:
+            return [(k, v, None if d == math.inf else d - now) for k, (d, v) in self._data.items() if d > now]
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "expired": self.expired, "heap": len(self._heap)}